@@ -1,11 +1,42 @@
-from flask import Flask, render_template, request, send_file
-from PIL import Image, ImageDraw
-import numpy as np
-import io
+from flask import Flask, Response, abort, g, render_template, request, send_file, make_response, redirect, url_for
+import contextlib
 import os
 
+import metrics
+from batch import parse_prompts, stream_batch
+from encoding import FORMATS, encode_image, encoded_key, negotiate_format
+import rasterizer
+from rasterizer import plan_shapes
+from render_cache import RenderCache, cache_key, is_cache_key
+from render_pool import Overloaded
+from seeds import SEED_VERSION
+from tiles import BASE_SIZE, MAX_SIZE, output_size, pyramid_levels, tiled_key, tiled_png
+
 app = Flask(__name__)
 
+# Bump whenever a change to generate_image alters its output, so stale
+# cached images and ETags are not reused
+RENDER_VERSION = 1
+
+# The two servers lay out different shapes for the same prompt; this keeps
+# their images apart in a cache directory they share
+RENDERER = 'numpy'
+
+# Seconds a request waits for an identical render already in progress
+RENDER_TIMEOUT = float(os.environ.get('RENDER_TIMEOUT', 30))
+
+# Prompts travel in image URLs; this keeps those URLs within the request
+# line limits of servers and proxies, even once percent-encoded
+MAX_PROMPT_BYTES = int(os.environ.get('MAX_PROMPT_BYTES', 1024))
+
+render_cache = RenderCache(
+    max_bytes=int(os.environ.get('IMAGE_CACHE_BYTES', 64 * 1024 * 1024)),
+    disk_dir=os.environ.get('IMAGE_CACHE_DIR'),
+    disk_max_bytes=int(os.environ.get('IMAGE_CACHE_DISK_BYTES', 1024 * 1024 * 1024)),
+)
+
+metrics.register_cache(render_cache)
+
 # Create templates directory if it doesn't exist
 if not os.path.exists('templates'):
     os.makedirs('templates')
@@ -14,62 +45,217 @@ if not os.path.exists('templates'):
 if not os.path.exists('static'):
     os.makedirs('static')
 
-def generate_image(prompt):
+def generate_image(prompt, seed_version=None, size=None, scale=None):
     """
     Generate a simple image based on the prompt.
     This is a very basic implementation that creates colored shapes.
-    """
-    # Create a blank white image
-    width, height = 400, 400
-    image = Image.new('RGB', (width, height), color='white')
-    draw = ImageDraw.Draw(image)
-    
-    # Simple "algorithm" to create different images based on the prompt
-    # Using the sum of character codes to seed the random generator
-    seed = sum(ord(c) for c in prompt)
-    np.random.seed(seed)
-    
-    # Draw some random shapes based on the prompt
-    for _ in range(5):
-        shape_type = np.random.choice(['rectangle', 'circle'])
-        color = (
-            np.random.randint(0, 256),
-            np.random.randint(0, 256),
-            np.random.randint(0, 256)
-        )
-        
-        x = np.random.randint(0, width)
-        y = np.random.randint(0, height)
-        
-        if shape_type == 'rectangle':
-            size = np.random.randint(20, 100)
-            draw.rectangle([x, y, x + size, y + size], fill=color)
-        else:
-            radius = np.random.randint(20, 100)
-            draw.ellipse([x, y, x + radius, y + radius], fill=color)
+    Safe to call from several threads at once.
     
-    return image
+    The shapes are laid out on a 400x400 canvas; ``size`` (pixels) or
+    ``scale`` draws them larger or smaller. Use ``tiles.stream_png`` for
+    sizes too large to hold in memory at once.
+    """
+    return rasterizer.generate_image(prompt, seed_version, output_size(size, scale))
+
+def prompt_shapes(prompt, seed_version=None):
+    """Return the prompt's shapes as plain rows, for the tiled renderer."""
+    return plan_shapes([prompt], seed_version)[0].tolist()
+
+def check_prompt(prompt):
+    """Abort with 400 if a prompt is too long to travel in an image URL."""
+    if len(prompt.encode('utf-8')) > MAX_PROMPT_BYTES:
+        abort(400, f'prompt is longer than {MAX_PROMPT_BYTES} bytes')
+
+def image_key(prompt):
+    """Return the cache key identifying the image rendered for a prompt."""
+    return cache_key(prompt, renderer=RENDERER, size=(400, 400), version=RENDER_VERSION, seed=SEED_VERSION)
+
+def render_encoded(prompt, fmt='png'):
+    """Return the prompt's image encoded as fmt, rendering only on a cache miss.
+
+    Concurrent requests for the same image share a single render.
+    """
+    return render_cache.get_or_render(
+        encoded_key(image_key(prompt), fmt),
+        lambda: encode_image(generate_image(prompt), fmt),
+        timeout=RENDER_TIMEOUT,
+    )
+
+def render_png(prompt):
+    """Return the PNG bytes for a prompt."""
+    return render_encoded(prompt, 'png')
+
+def png_key(prompt):
+    """Return the cache key of the prompt's PNG."""
+    return encoded_key(image_key(prompt), 'png')
+
+def draw_png(prompt):
+    """Render the prompt's PNG without the cache, for batch workers."""
+    return encode_image(generate_image(prompt), 'png')
+
+@app.before_request
+def start_request_metrics():
+    route = request.url_rule.rule if request.url_rule else 'other'
+    g.request_metrics = contextlib.ExitStack()
+    g.request_metrics.enter_context(metrics.track_request(route))
+
+@app.after_request
+def count_response_bytes(response):
+    # Streamed responses count their bytes as they are written
+    if not response.is_streamed:
+        route = request.url_rule.rule if request.url_rule else 'other'
+        metrics.count_bytes(route, response.calculate_content_length() or 0)
+    else:
+        # Flask tears the request down before a streamed body is sent, so
+        # keep timing it, and collecting its stages, until the body closes
+        request_metrics = g.pop('request_metrics', None)
+        if request_metrics is not None:
+            response.call_on_close(request_metrics.close)
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    request_metrics = g.pop('request_metrics', None)
+    if request_metrics is not None:
+        request_metrics.close()
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
-    image_data = None
+    image_url = None
     
     if request.method == 'POST':
         prompt = request.form.get('prompt', '')
         if prompt:
-            # Generate image
-            image = generate_image(prompt)
-            
-            # Convert PIL image to bytes
-            img_io = io.BytesIO()
-            image.save(img_io, 'PNG')
-            img_io.seek(0)
-            
-            # Convert to base64 for embedding in HTML
-            import base64
-            image_data = base64.b64encode(img_io.getvalue()).decode('ascii')
+            metrics.set_prompt(prompt)
+            check_prompt(prompt)
+            # The page only links to the image; the browser fetches the
+            # bytes from /image, picking the format it prefers, and
+            # revalidates them there with their ETag. The URL carries the
+            # prompt, so any process can render it.
+            image_url = url_for('image', name=image_key(prompt), prompt=prompt)
+    
+    with metrics.stage('template'):
+        html = render_template('index.html', image_url=image_url)
+    return html
+
+@app.route('/image/<name>')
+def image(name):
+    key, _, ext = name.partition('.')
+    if not is_cache_key(key):
+        abort(404)
+    try:
+        size = int(request.args.get('size', BASE_SIZE))
+        level = int(request.args.get('level', 0))
+    except ValueError:
+        abort(400)
+    if size != BASE_SIZE or level:
+        return tiled_image(key, ext, size, level)
+    if ext:
+        if ext not in FORMATS:
+            abort(404)
+        fmt = ext
+    else:
+        fmt = negotiate_format(request.headers.get('Accept'))
+        if fmt is None:
+            abort(406)
+    
+    prompt = request.args.get('prompt')
+    if prompt is None:
+        abort(404)
+    check_prompt(prompt)
+    if image_key(prompt) != key:
+        return current_image(prompt, ext)
+    metrics.set_prompt(prompt)
+    
+    etag = encoded_key(key, fmt)
+    if request.if_none_match.contains_weak(etag):
+        response = make_response('', 304)
+    else:
+        try:
+            data = render_encoded(prompt, fmt)
+        except TimeoutError:
+            return Response(status=503, headers={'Retry-After': '1'})
+        response = Response(data, mimetype=FORMATS[fmt])
+    response.set_etag(etag)
+    if not ext:
+        response.vary.add('Accept')
+    return response
+
+def current_image(prompt, ext):
+    """Redirect to the image URL of a prompt under the current key.
+    
+    Keys change when the render version, seed or settings do; pages made
+    before that still link to the old key.
+    """
+    name = image_key(prompt) + ('.' + ext if ext else '')
+    return redirect(url_for('image', name=name, **request.args))
+
+def tiled_image(key, ext, size, level):
+    """Serve /image/<key>?size=N[&level=L] as a PNG rendered band by band.
     
-    return render_template('index.html', image_data=image_data)
+    An image not yet cached is streamed while it is encoded; its pyramid
+    levels are cached on the way, for /image/<key>?size=N&level=L.
+    """
+    if ext and ext != 'png':
+        abort(404)
+    if not 1 <= size <= MAX_SIZE or not 0 <= level <= pyramid_levels(size):
+        abort(400)
+    
+    prompt = request.args.get('prompt')
+    if prompt is None:
+        abort(404)
+    check_prompt(prompt)
+    if image_key(prompt) != key:
+        return current_image(prompt, ext)
+    metrics.set_prompt(prompt)
+    
+    etag = tiled_key(key, size, level)
+    if request.if_none_match.contains_weak(etag):
+        response = make_response('', 304)
+        response.set_etag(etag)
+        return response
+    
+    try:
+        data = tiled_png(render_cache, key, prompt_shapes(prompt), size, level, timeout=RENDER_TIMEOUT)
+    except (Overloaded, TimeoutError):
+        return Response(status=503, headers={'Retry-After': '1'})
+    if not isinstance(data, bytes):
+        chunks = data
+        
+        def stream():
+            for chunk in chunks:
+                metrics.count_bytes('/image/<name>', len(chunk))
+                yield chunk
+        
+        data = stream()
+    response = Response(data, mimetype=FORMATS['png'])
+    response.set_etag(etag)
+    return response
+
+@app.route('/generate/batch', methods=['POST'])
+def generate_batch():
+    try:
+        prompts = parse_prompts(request.get_data())
+    except ValueError as exc:
+        return {'error': str(exc)}, 400
+    
+    results = stream_batch(prompts, draw_png, render_cache, png_key)
+    
+    # Werkzeug closes the generator when the client disconnects, which
+    # cancels the renders still queued
+    def stream():
+        try:
+            for line in results:
+                metrics.count_bytes('/generate/batch', len(line))
+                yield line
+        finally:
+            results.close()
+    
+    return Response(stream(), mimetype='application/x-ndjson')
+
+@app.route('/metrics')
+def metrics_text():
+    return Response(metrics.render_text(), content_type=metrics.CONTENT_TYPE)
 
 if __name__ == '__main__':
     app.run(debug=True) 
\ No newline at end of file
@@ -1,60 +1,264 @@
+import argparse
+import concurrent.futures
+import contextvars
 import http.server
-import socketserver
+import signal
+import threading
 import urllib.parse
 import json
 import random
 import base64
-import io
-from PIL import Image, ImageDraw
+import os
+import metrics
+import tiles
+from batch import parse_prompts, stream_batch
+from encoding import FORMATS, encode_image, encoded_key, negotiate_format
+from render_cache import RenderCache, cache_key, is_cache_key, etag_matches, make_etag
+from render_pool import RENDER_MAX_QUEUE, RENDER_WORKERS, Overloaded, RenderPool
+from seeds import SEED_VERSION, prompt_seed
+from tiles import BASE_SIZE, CIRCLE, MAX_SIZE, RECTANGLE, output_size, pyramid_levels, tiled_key, tiled_png
 
 PORT = 8080
 
-def generate_image(prompt):
-    """Generate a simple image based on the prompt."""
-    # Create a blank white image
-    width, height = 400, 400
-    image = Image.new('RGB', (width, height), color='white')
-    draw = ImageDraw.Draw(image)
+# Defaults for the pooled server; each can also be set on the command line
+HTTP_WORKERS = int(os.environ.get('HTTP_WORKERS', 32))
+HTTP_MAX_QUEUE = int(os.environ.get('HTTP_MAX_QUEUE', 64))
+
+# Seconds an idle keep-alive connection may hold a worker
+KEEPALIVE_TIMEOUT = 5
+
+# Seconds clients are asked to wait before retrying after a 503
+RETRY_AFTER = 1
+
+# Seconds a request waits for an identical render already in progress
+RENDER_TIMEOUT = float(os.environ.get('RENDER_TIMEOUT', 30))
+
+# Prompts travel in image URLs; this keeps those URLs within the request
+# line limits of servers and proxies, even once percent-encoded
+MAX_PROMPT_BYTES = int(os.environ.get('MAX_PROMPT_BYTES', 1024))
+
+# Bump whenever a change to draw_image alters its output, so stale cached
+# images and ETags are not reused
+RENDER_VERSION = 1
+
+# The two servers lay out different shapes for the same prompt; this keeps
+# their images apart in a cache directory they share
+RENDERER = 'stdlib'
+
+render_cache = RenderCache(
+    max_bytes=int(os.environ.get('IMAGE_CACHE_BYTES', 64 * 1024 * 1024)),
+    disk_dir=os.environ.get('IMAGE_CACHE_DIR'),
+    disk_max_bytes=int(os.environ.get('IMAGE_CACHE_DISK_BYTES', 1024 * 1024 * 1024)),
+)
+
+metrics.register_cache(render_cache)
+
+def draw_image(prompt, seed_version=None, size=None, scale=None):
+    """Draw the image for a prompt. Safe to call from several threads at once.
+
+    The shapes are laid out on a 400x400 canvas; ``size`` (pixels) or
+    ``scale`` draws them larger or smaller. Use ``tiles.stream_png`` for
+    sizes too large to hold in memory at once.
+    """
+    size = output_size(size, scale)
+    with metrics.stage('seed'):
+        shapes = plan_shapes(prompt, seed_version)
     
-    # Use the prompt to seed random generator
-    seed = sum(ord(c) for c in prompt)
-    random.seed(seed)
+    with metrics.stage('draw'):
+        return tiles.draw_image(shapes, size)
+
+def plan_shapes(prompt, seed_version=None):
+    """Return the prompt's shapes as (kind, red, green, blue, x, y, size) rows.
+
+    Coordinates are on the 400x400 canvas, in drawing order.
+    """
+    # Use the prompt to seed a generator of our own; the module-level one
+    # is shared by every thread rendering at the same time
+    rng = random.Random(prompt_seed(prompt, seed_version))
+    width, height = BASE_SIZE, BASE_SIZE
     
-    # Draw some random shapes
+    shapes = []
     for _ in range(5):
-        shape_type = random.choice(['rectangle', 'circle'])
+        shape_type = rng.choice(['rectangle', 'circle'])
         color = (
-            random.randint(0, 255),
-            random.randint(0, 255),
-            random.randint(0, 255)
+            rng.randint(0, 255),
+            rng.randint(0, 255),
+            rng.randint(0, 255)
         )
         
-        x = random.randint(0, width-100)
-        y = random.randint(0, height-100)
+        x = rng.randint(0, width-100)
+        y = rng.randint(0, height-100)
         
-        if shape_type == 'rectangle':
-            size = random.randint(20, 100)
-            draw.rectangle([x, y, x + size, y + size], fill=color)
-        else:
-            radius = random.randint(20, 100)
-            draw.ellipse([x, y, x + radius, y + radius], fill=color)
-    
-    # Convert to base64
-    img_buffer = io.BytesIO()
-    image.save(img_buffer, format='PNG')
-    img_buffer.seek(0)
-    img_base64 = base64.b64encode(img_buffer.read()).decode('utf-8')
+        # The same draw sizes a rectangle or a circle
+        size = rng.randint(20, 100)
+        kind = RECTANGLE if shape_type == 'rectangle' else CIRCLE
+        shapes.append((kind, *color, x, y, size))
     
-    return img_base64
+    return shapes
+
+def image_key(prompt):
+    """Return the cache key identifying the image rendered for a prompt."""
+    return cache_key(prompt, renderer=RENDERER, size=(400, 400), version=RENDER_VERSION, seed=SEED_VERSION)
+
+def image_url(prompt, ext='', **params):
+    """Return the /image URL of a prompt's image.
+
+    The URL carries the prompt, so any process can render it.
+    """
+    name = image_key(prompt) + ('.' + ext if ext else '')
+    return f'/image/{name}?' + urllib.parse.urlencode({**params, 'prompt': prompt})
+
+def render_encoded(prompt, fmt='png', pool=None):
+    """Return the prompt's image encoded as fmt, rendering only on a cache miss.
+
+    When a RenderPool is given, a miss is rendered on it; cache hits never
+    wait for a render slot. Concurrent requests for the same image share a
+    single render.
+    """
+    def render():
+        return encode_image(draw_image(prompt), fmt)
+
+    return render_cache.get_or_render(
+        encoded_key(image_key(prompt), fmt),
+        (lambda: pool.run(render)) if pool else render,
+        timeout=RENDER_TIMEOUT,
+    )
+
+def generate_png(prompt):
+    """Return the PNG bytes for a prompt."""
+    return render_encoded(prompt, 'png')
+
+def png_key(prompt):
+    """Return the cache key of the prompt's PNG."""
+    return encoded_key(image_key(prompt), 'png')
+
+def draw_png(prompt):
+    """Render the prompt's PNG without the cache, for batch workers."""
+    return encode_image(draw_image(prompt), 'png')
+
+def generate_image(prompt):
+    """Generate a simple image based on the prompt, as base64-encoded PNG."""
+    png = generate_png(prompt)
+    with metrics.stage('base64'):
+        return base64.b64encode(png).decode('utf-8')
+
+class PooledHTTPServer(http.server.HTTPServer):
+    """HTTP server handling connections on a bounded thread pool.
+
+    Up to ``workers`` connections are served at once and ``max_queue`` more
+    may wait for a thread. Connections beyond that are answered with 503
+    and Retry-After right away. Renders run on a separate RenderPool so
+    that cheap requests such as cache hits are not stuck behind them.
+    """
+
+    def __init__(self, server_address, handler_class, workers=HTTP_WORKERS,
+                 max_queue=HTTP_MAX_QUEUE, render_pool=None):
+        super().__init__(server_address, handler_class)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='http')
+        self.render_pool = render_pool or RenderPool()
+        self.shutting_down = False
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+
+    def process_request(self, request, client_address):
+        if not self._slots.acquire(blocking=False):
+            self.reject_request(request)
+            return
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def reject_request(self, request):
+        try:
+            request.sendall(
+                b'HTTP/1.1 503 Service Unavailable\r\n'
+                b'Retry-After: %d\r\n'
+                b'Content-Length: 0\r\n'
+                b'Connection: close\r\n\r\n' % RETRY_AFTER
+            )
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def graceful_shutdown(self):
+        """Stop accepting connections and finish the requests in flight.
+
+        Must be called from another thread than the one in serve_forever.
+        """
+        self.shutting_down = True
+        self.shutdown()
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+        self.render_pool.shutdown()
 
 class ImageGeneratorHandler(http.server.SimpleHTTPRequestHandler):
+    # Keep connections open between requests; every response therefore
+    # carries a Content-Length or is chunked, except batch streams, which
+    # close the connection
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEPALIVE_TIMEOUT
+
+    def end_headers(self):
+        if getattr(self.server, 'shutting_down', False):
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        super().end_headers()
+
+    def render(self, prompt, fmt='png'):
+        """Return the encoded image, or None after answering 503 when overloaded."""
+        try:
+            return render_encoded(prompt, fmt, getattr(self.server, 'render_pool', None))
+        except (Overloaded, TimeoutError):
+            self.send_response(503)
+            self.send_header('Retry-After', str(RETRY_AFTER))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+
+    def check_prompt(self, prompt):
+        """Return whether a prompt fits in an image URL, answering 400 if not."""
+        if len(prompt.encode('utf-8')) <= MAX_PROMPT_BYTES:
+            return True
+        self.send_error(400, f'prompt is longer than {MAX_PROMPT_BYTES} bytes')
+        return False
+
+    def route(self):
+        """Return the route a request path belongs to, for metrics labels."""
+        path = urllib.parse.urlparse(self.path).path
+        if path.startswith('/image/'):
+            return '/image'
+        if path in ('/', '/index.html', '/generate', '/generate/batch', '/metrics'):
+            return path
+        return 'other'
+
+    def write(self, data):
+        """Write part of a response body, counting its time and size."""
+        with metrics.stage('write'):
+            self.wfile.write(data)
+        metrics.count_bytes(self.route(), len(data))
+
     def do_GET(self):
         """Handle GET requests."""
-        if self.path == '/' or self.path == '/index.html':
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html')
-            self.end_headers()
-            
+        with metrics.track_request(self.route()):
+            self.handle_get()
+
+    def do_POST(self):
+        """Handle POST requests."""
+        with metrics.track_request(self.route()):
+            self.handle_post()
+
+    def handle_get(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path == '/' or url.path == '/index.html':
             # Serve the HTML page
             html = f'''
             <!DOCTYPE html>
@@ -117,43 +321,293 @@ class ImageGeneratorHandler(http.server.SimpleHTTPRequestHandler):
                         e.preventDefault();
                         const prompt = document.getElementById('prompt').value;
                         
-                        // Send request to generate image
-                        const response = await fetch('/generate?prompt=' + encodeURIComponent(prompt));
+                        // Ask for the image URL only; the browser then fetches
+                        // the bytes in the format it prefers
+                        const response = await fetch('/generate?inline=0&prompt=' + encodeURIComponent(prompt));
+                        const imageContainer = document.getElementById('image-display');
+                        if (!response.ok) {{
+                            imageContainer.textContent = response.statusText;
+                            return;
+                        }}
                         const data = await response.json();
                         
                         // Display the image
-                        const imageContainer = document.getElementById('image-display');
-                        imageContainer.innerHTML = `<img src="data:image/png;base64,${{data.image}}" alt="Generated image">`;
+                        imageContainer.innerHTML = `<img src="${{data.url}}" alt="Generated image">`;
                     }});
                 </script>
             </body>
             </html>
             '''
-            self.wfile.write(html.encode('utf-8'))
-        elif self.path.startswith('/generate'):
+            body = html.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-type', 'text/html')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.write(body)
+        elif url.path == '/generate':
             # Parse the query parameters
-            query_components = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+            query_components = urllib.parse.parse_qs(url.query)
             prompt = query_components.get('prompt', [''])[0]
+            metrics.set_prompt(prompt)
+            if not self.check_prompt(prompt):
+                return
+            key = image_key(prompt)
+            url = image_url(prompt)
+            
+            if query_components.get('inline', ['1'])[0] == '0':
+                self.send_json({'url': url})
+                return
+            
+            etag = make_etag(encoded_key(key, 'png'))
+            
+            # Identical prompts give identical images, so a client that
+            # already has this one can keep it
+            if etag_matches(self.headers.get('If-None-Match'), etag):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
             
             # Generate the image
-            img_base64 = generate_image(prompt)
+            png = self.render(prompt)
+            if png is None:
+                return
             
             # Send response
+            with metrics.stage('base64'):
+                img_base64 = base64.b64encode(png).decode('utf-8')
+            response = {
+                'image': img_base64,
+                'url': url
+            }
+            self.send_json(response, {'ETag': etag})
+        elif url.path == '/generate/batch':
+            self.send_response(405)
+            self.send_header('Allow', 'POST')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif url.path.startswith('/image/'):
+            self.send_image(url.path[len('/image/'):], urllib.parse.parse_qs(url.query, keep_blank_values=True))
+        elif url.path == '/metrics':
+            body = metrics.render_text().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-type', metrics.CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.write(body)
+        else:
+            self.send_error(404)
+
+    def send_json(self, data, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.write(body)
+
+    def send_image(self, name, query=None):
+        """Send the raw encoded bytes for /image/<key>[.<format>]."""
+        key, _, ext = name.partition('.')
+        if not is_cache_key(key):
+            self.send_error(404)
+            return
+        query = query or {}
+        try:
+            size = int(query.get('size', [BASE_SIZE])[0])
+            level = int(query.get('level', [0])[0])
+        except ValueError:
+            self.send_error(400)
+            return
+        if size != BASE_SIZE or level:
+            self.send_tiled_image(key, ext, size, level, query)
+            return
+        if ext:
+            if ext not in FORMATS:
+                self.send_error(404)
+                return
+            fmt = ext
+        else:
+            fmt = negotiate_format(self.headers.get('Accept'))
+            if fmt is None:
+                self.send_error(406)
+                return
+        
+        prompt = query.get('prompt', [None])[0]
+        if prompt is None:
+            self.send_error(404)
+            return
+        if not self.check_prompt(prompt):
+            return
+        if image_key(prompt) != key:
+            self.redirect_to_current(prompt, ext, query)
+            return
+        metrics.set_prompt(prompt)
+        
+        etag = make_etag(encoded_key(key, fmt))
+        if etag_matches(self.headers.get('If-None-Match'), etag):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        
+        data = self.render(prompt, fmt)
+        if data is None:
+            return
+        self.send_response(200)
+        self.send_header('Content-type', FORMATS[fmt])
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag)
+        if not ext:
+            self.send_header('Vary', 'Accept')
+        self.end_headers()
+        self.write(data)
+
+    def redirect_to_current(self, prompt, ext, query):
+        """Redirect to the image URL of a prompt under the current key.
+
+        Keys change when the render version, seed or settings do; pages
+        made before that still link to the old key.
+        """
+        params = {name: values[0] for name, values in query.items() if name != 'prompt'}
+        self.send_response(302)
+        self.send_header('Location', image_url(prompt, ext, **params))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def send_tiled_image(self, key, ext, size, level, query):
+        """Send /image/<key>?size=N[&level=L] as a PNG rendered band by band.
+
+        An image not yet cached is sent with chunked transfer encoding while
+        it is encoded; its pyramid levels are cached on the way.
+        """
+        if ext and ext != 'png':
+            self.send_error(404)
+            return
+        if not 1 <= size <= MAX_SIZE or not 0 <= level <= pyramid_levels(size):
+            self.send_error(400)
+            return
+        
+        prompt = query.get('prompt', [None])[0]
+        if prompt is None:
+            self.send_error(404)
+            return
+        if not self.check_prompt(prompt):
+            return
+        if image_key(prompt) != key:
+            self.redirect_to_current(prompt, ext, query)
+            return
+        metrics.set_prompt(prompt)
+        
+        etag = make_etag(tiled_key(key, size, level))
+        if etag_matches(self.headers.get('If-None-Match'), etag):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        
+        try:
+            pool = getattr(self.server, 'render_pool', None)
+            data = tiled_png(render_cache, key, plan_shapes(prompt), size, level,
+                             timeout=RENDER_TIMEOUT, submit=pool.submit if pool else None)
+        except (Overloaded, TimeoutError):
+            self.send_response(503)
+            self.send_header('Retry-After', str(RETRY_AFTER))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        
+        self.send_response(200)
+        self.send_header('Content-type', FORMATS['png'])
+        self.send_header('ETag', etag)
+        if isinstance(data, bytes):
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.write(data)
+            return
+        
+        # Chunked encoding marks the end of the body, so the connection can
+        # be kept open even though the length is not known up front
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for chunk in data:
+                self.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                self.wfile.flush()
+            self.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away; the render still finishes for the
+            # cache and any waiters
+            self.close_connection = True
+        finally:
+            data.close()
+
+    def handle_post(self):
+        if self.path == '/generate/batch':
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+            except ValueError:
+                length = -1
+            if length < 0:
+                self.send_error(400, 'invalid Content-Length')
+                return
+            try:
+                prompts = parse_prompts(self.rfile.read(length))
+            except ValueError as exc:
+                self.send_error(400, str(exc))
+                return
+            
+            # One JSON line per prompt, written as each one finishes. The
+            # length is not known up front, so the end of the stream is
+            # marked by closing the connection.
             self.send_response(200)
-            self.send_header('Content-type', 'application/json')
+            self.send_header('Content-type', 'application/x-ndjson')
+            self.send_header('Connection', 'close')
             self.end_headers()
+            self.close_connection = True
             
-            response = {
-                'image': img_base64
-            }
-            self.wfile.write(json.dumps(response).encode('utf-8'))
+            results = stream_batch(prompts, draw_png, render_cache, png_key)
+            try:
+                for line in results:
+                    self.write(line)
+                    self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                # The client went away; closing the stream cancels the rest
+                pass
+            finally:
+                results.close()
         else:
             self.send_error(404)
 
-def run_server():
-    with socketserver.TCPServer(("", PORT), ImageGeneratorHandler) as httpd:
-        print(f"Server running at http://localhost:{PORT}")
+def run_server(port=PORT, workers=HTTP_WORKERS, max_queue=HTTP_MAX_QUEUE,
+               render_workers=RENDER_WORKERS, render_max_queue=RENDER_MAX_QUEUE):
+    render_pool = RenderPool(render_workers, render_max_queue)
+    with PooledHTTPServer(("", port), ImageGeneratorHandler, workers, max_queue, render_pool) as httpd:
+        # serve_forever must be stopped from another thread
+        def stop(signum, frame):
+            threading.Thread(target=httpd.graceful_shutdown).start()
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        
+        print(f"Server running at http://localhost:{port}")
         httpd.serve_forever()
+    print("Server stopped")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Image generator server')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--workers', type=int, default=HTTP_WORKERS,
+                        help='connections served at once')
+    parser.add_argument('--max-queue', type=int, default=HTTP_MAX_QUEUE,
+                        help='connections waiting for a worker before 503')
+    parser.add_argument('--render-workers', type=int, default=RENDER_WORKERS,
+                        help='renders run at once')
+    parser.add_argument('--render-max-queue', type=int, default=RENDER_MAX_QUEUE,
+                        help='renders waiting for a worker before 503')
+    return parser.parse_args()
 
 if __name__ == "__main__":
-    run_server() 
\ No newline at end of file
+    args = parse_args()
+    run_server(args.port, args.workers, args.max_queue, args.render_workers, args.render_max_queue) 
\ No newline at end of file
@@ -0,0 +1,140 @@
+"""
+Batch rendering on a process pool, streamed back as NDJSON.
+
+Each prompt of a batch is rendered and encoded in a worker process, so long
+batches are not limited by the GIL. Results are yielded one JSON line at a
+time as soon as they are ready, in completion order, and carry the index of
+their prompt in the request.
+
+Workers keep no cache of their own: the server's cache is checked before a
+prompt is sent to the pool and filled with what comes back, so a prompt is
+rendered once whichever worker or request asked for it first.
+"""
+import base64
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import threading
+
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', os.cpu_count() or 1))
+
+# Renders queued on the pool at once for a single batch. Results are
+# written out as they finish, so this bounds memory however long the
+# batch is.
+BATCH_MAX_PENDING = int(os.environ.get('BATCH_MAX_PENDING', 2 * BATCH_WORKERS))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Return the shared process pool, starting it on first use."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # The pool starts from a server thread while other threads may
+            # hold locks; a forked child would inherit those locks held
+            # forever, so workers start from a fresh interpreter instead
+            _executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=BATCH_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return _executor
+
+
+def _submit(render, prompt):
+    global _executor
+    executor = get_executor()
+    try:
+        return executor.submit(render, prompt)
+    except concurrent.futures.BrokenExecutor:
+        # A worker died and the pool cannot take new work; swap in a fresh one
+        with _executor_lock:
+            if _executor is executor:
+                _executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+        return get_executor().submit(render, prompt)
+
+
+def parse_prompts(body):
+    """Return the prompt list from a batch request body, or raise ValueError.
+
+    The body is either a JSON list of prompts or an object with a
+    ``prompts`` list.
+    """
+    try:
+        data = json.loads(body)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError('request body must be JSON')
+    if isinstance(data, dict):
+        data = data.get('prompts')
+    if not isinstance(data, list):
+        raise ValueError('expected a list of prompts')
+    return data
+
+
+def _line(**fields):
+    return (json.dumps(fields) + '\n').encode('utf-8')
+
+
+def _image_line(index, prompt, png):
+    return _line(index=index, prompt=prompt, image=base64.b64encode(png).decode('ascii'))
+
+
+def stream_batch(prompts, render, cache=None, key=None, executor=None, max_pending=None):
+    """Render prompts on the process pool, yielding one NDJSON line each.
+
+    ``render`` must be a picklable function taking a prompt and returning
+    its PNG. With a ``cache``, prompts whose ``key(prompt)`` is cached are
+    answered without going to the pool, and rendered PNGs are stored there.
+    A prompt repeated within the batch is rendered once. A line holds
+    either the base64 ``image`` or, when that prompt failed, ``error``; one
+    bad prompt does not stop the batch. Closing the generator, which is
+    what the servers do when the client disconnects, cancels every render
+    that has not started yet.
+    """
+    submit = executor.submit if executor else _submit
+    max_pending = max_pending or BATCH_MAX_PENDING
+    queued = enumerate(prompts)
+    # future -> (key, [(index, prompt), ...]) and key -> its future
+    pending = {}
+    rendering = {}
+    try:
+        while True:
+            for index, prompt in queued:
+                if not isinstance(prompt, str):
+                    yield _line(index=index, prompt=prompt, error='prompt must be a string')
+                    continue
+                name = key(prompt) if key else prompt
+                if name in rendering:
+                    pending[rendering[name]][1].append((index, prompt))
+                    continue
+                png = cache.get(name) if cache is not None else None
+                if png is not None:
+                    yield _image_line(index, prompt, png)
+                    continue
+                future = submit(render, prompt)
+                rendering[name] = future
+                pending[future] = (name, [(index, prompt)])
+                if len(pending) >= max_pending:
+                    break
+            if not pending:
+                return
+
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name, waiting = pending.pop(future)
+                del rendering[name]
+                try:
+                    png = future.result()
+                except Exception as exc:
+                    error = f'{type(exc).__name__}: {exc}'
+                    for index, prompt in waiting:
+                        yield _line(index=index, prompt=prompt, error=error)
+                    continue
+                if cache is not None:
+                    cache.put(name, png)
+                for index, prompt in waiting:
+                    yield _image_line(index, prompt, png)
+    finally:
+        for future in pending:
+            future.cancel()
@@ -0,0 +1,9 @@
+"""
+Benchmarks for the image generator.
+
+Run from the repository root, for example::
+
+    python -m benchmarks.corpus --count 2000 --repeat-ratio 0.5 > corpus.jsonl
+    python -m benchmarks.run --corpus corpus.jsonl --out report.json
+    python -m benchmarks.compare before.json after.json
+"""
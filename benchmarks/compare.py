@@ -0,0 +1,58 @@
+"""
+Compare two benchmark reports.
+
+    python -m benchmarks.compare before.json after.json [--threshold 10]
+
+Prints the change of every shared metric and exits with status 1 when any
+latency grew, or any throughput fell, by more than the threshold percent.
+"""
+import argparse
+import json
+import sys
+
+# Metrics where a larger value is worse
+LOWER_IS_BETTER = ('p50_ms', 'p95_ms', 'p99_ms', 'mean_ms', 'cpu_s', 'server_cpu_s', 'server_peak_rss_mb')
+HIGHER_IS_BETTER = ('per_s',)
+
+
+def compare(before, after, threshold):
+    """Return (rows, regressions) for the results both reports share."""
+    rows = []
+    regressions = []
+    for name in sorted(set(before['results']) & set(after['results'])):
+        old, new = before['results'][name], after['results'][name]
+        for metric in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+            if old.get(metric) in (None, 0) or new.get(metric) is None:
+                continue
+            change = (new[metric] - old[metric]) / old[metric] * 100
+            worse = change > threshold if metric in LOWER_IS_BETTER else change < -threshold
+            rows.append((name, metric, old[metric], new[metric], change, worse))
+            if worse:
+                regressions.append((name, metric))
+    return rows, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare two benchmark reports')
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=10.0, help='percent change counted as a regression')
+    args = parser.parse_args(argv)
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    print(f"before: {before['environment'].get('commit')}")
+    print(f"after:  {after['environment'].get('commit')}")
+    rows, regressions = compare(before, after, args.threshold)
+    for name, metric, old, new, change, worse in rows:
+        flag = '  REGRESSION' if worse else ''
+        print(f'{name:40} {metric:20} {old:>12} {new:>12} {change:+8.1f}%{flag}')
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Replayable prompt corpora in JSONL.
+
+Each line is one request in the same shape as the backlog file: a JSON
+object with a ``request_id``. A corpus line adds the ``prompt`` and ``at``,
+its arrival time in seconds from the start of the run::
+
+    {"request_id": "bench-000001", "prompt": "red fox at dawn", "at": 0.0132}
+
+Lines without a ``prompt`` fall back to their ``title``, so the backlog
+file itself can be replayed; lines without ``at`` are sent back to back.
+"""
+import argparse
+import json
+import random
+import sys
+
+WORDS = (
+    'red green blue yellow purple orange pink black white golden silver '
+    'cat dog fox owl whale tree river mountain city forest ocean desert '
+    'sunset sunrise night storm garden castle robot dragon flower cloud '
+    'abstract minimal bright dark calm wild ancient futuristic tiny giant '
+    'on in under over near behind with without a the of and'
+).split()
+
+
+def generate(count, repeat_ratio=0.0, mean_words=6, max_words=40, rate=None, seed=0):
+    """Yield corpus entries.
+
+    ``repeat_ratio`` is the share of requests that reuse an earlier prompt,
+    picked with a bias towards popular ones. Prompt lengths in words follow
+    a geometric distribution with the given mean, capped at ``max_words``.
+    With ``rate`` (requests per second), arrivals are a Poisson process;
+    without it every ``at`` is 0 and requests are sent as fast as possible.
+    """
+    rng = random.Random(seed)
+    seen = []
+    at = 0.0
+    for index in range(count):
+        if seen and rng.random() < repeat_ratio:
+            # Squaring the uniform favours the earliest, most repeated prompts
+            prompt = seen[int(rng.random() ** 2 * len(seen))]
+        else:
+            length = 1
+            while length < max_words and rng.random() > 1 / mean_words:
+                length += 1
+            prompt = ' '.join(rng.choice(WORDS) for _ in range(length))
+            seen.append(prompt)
+        if rate:
+            at += rng.expovariate(rate)
+        yield {'request_id': f'bench-{index + 1:06d}', 'prompt': prompt, 'at': round(at, 6)}
+
+
+def load(path):
+    """Read a corpus file into a list of (at, prompt) tuples."""
+    entries = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            prompt = entry.get('prompt', entry.get('title'))
+            if prompt is None:
+                continue
+            entries.append((float(entry.get('at', 0.0)), prompt))
+    return entries
+
+
+def describe(entries):
+    """Summarise a corpus: size, distinct prompts, lengths and offered rate."""
+    prompts = [prompt for _, prompt in entries]
+    lengths = sorted(len(prompt) for prompt in prompts)
+    duration = max((at for at, _ in entries), default=0.0)
+    return {
+        'requests': len(entries),
+        'distinct_prompts': len(set(prompts)),
+        'repeat_ratio': 1 - len(set(prompts)) / len(prompts) if prompts else 0.0,
+        'prompt_chars_p50': lengths[len(lengths) // 2] if lengths else 0,
+        'prompt_chars_max': lengths[-1] if lengths else 0,
+        'offered_rate': len(entries) / duration if duration else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write a benchmark prompt corpus as JSONL to stdout')
+    parser.add_argument('--count', type=int, default=1000)
+    parser.add_argument('--repeat-ratio', type=float, default=0.0)
+    parser.add_argument('--mean-words', type=float, default=6)
+    parser.add_argument('--max-words', type=int, default=40)
+    parser.add_argument('--rate', type=float, default=None, help='requests per second; default is back to back')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    for entry in generate(args.count, args.repeat_ratio, args.mean_words, args.max_words, args.rate, args.seed):
+        sys.stdout.write(json.dumps(entry) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""
+End-to-end load tests against locally started servers.
+
+Each target is started as a subprocess on a free port, then the corpus is
+replayed against it from a pool of keep-alive client connections. Requests
+are sent at their corpus arrival times (open loop), and latency is measured
+from that scheduled time, so a server that falls behind shows its queueing
+delay instead of hiding it by slowing the client down.
+"""
+import concurrent.futures
+import html
+import http.client
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+from benchmarks.report import process_usage, summarize
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMAGE_SRC = re.compile(rb'<img src="([^"]+)"')
+
+
+def _flask_request(prompt):
+    body = urllib.parse.urlencode({'prompt': prompt})
+    return 'POST', '/', body, {'Content-Type': 'application/x-www-form-urlencoded'}
+
+
+def _simple_request(prompt):
+    return 'GET', '/generate?' + urllib.parse.urlencode({'prompt': prompt}), None, {}
+
+
+TARGETS = {
+    # The index route, then the image it links to unless fetch_images is
+    # off, so the flask numbers include the render like the simple ones
+    'flask': (
+        [sys.executable, '-c',
+         'import sys, app; app.app.run(host="127.0.0.1", port=int(sys.argv[1]), threaded=True)'],
+        _flask_request,
+    ),
+    'simple': (
+        [sys.executable, 'app_simple.py', '--port'],
+        _simple_request,
+    ),
+}
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for_port(port, proc, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f'server exited with status {proc.returncode}')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'server did not listen on port {port} within {timeout}s')
+
+
+def replay(port, entries, make_request, concurrency, fetch_images=True):
+    """Replay corpus entries against a server and return latencies and status counts."""
+    local = threading.local()
+    statuses = {}
+    lock = threading.Lock()
+    start = time.perf_counter()
+
+    def fetch(conn, method, path, body=None, headers=None):
+        conn.request(method, path, body, headers or {})
+        response = conn.getresponse()
+        return response.status, response.read()
+
+    def send(entry):
+        at, prompt = entry
+        scheduled = start + at
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        # Late requests count their wait from the scheduled time; without an
+        # arrival time the corpus is replayed closed loop
+        sent = scheduled if at else time.perf_counter()
+
+        conn = getattr(local, 'conn', None)
+        if conn is None:
+            conn = local.conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        try:
+            status, body = fetch(conn, *make_request(prompt))
+            if fetch_images and status == 200:
+                match = IMAGE_SRC.search(body)
+                if match:
+                    status, _ = fetch(conn, 'GET', html.unescape(match.group(1).decode()))
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            local.conn = None
+            status = 'error'
+        latency = time.perf_counter() - sent
+        with lock:
+            statuses[status] = statuses.get(status, 0) + 1
+        return latency if status == 200 else None
+
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(send, entries))
+    elapsed = time.perf_counter() - start
+    latencies = [latency for latency in results if latency is not None]
+    return latencies, elapsed, statuses
+
+
+def run(target, entries, concurrency=8, fetch_images=True):
+    """Start ``target`` locally, replay the corpus against it and stop it."""
+    command, make_request = TARGETS[target]
+    port = _free_port()
+    proc = subprocess.Popen(
+        command + [str(port)], cwd=ROOT,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        _wait_for_port(port, proc)
+        cpu_before, _ = process_usage(proc.pid)
+        latencies, elapsed, statuses = replay(port, entries, make_request, concurrency, fetch_images)
+        cpu_after, peak_rss = process_usage(proc.pid)
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+    errors = sum(count for status, count in statuses.items() if status != 200)
+    result = summarize(latencies, elapsed, errors)
+    result['statuses'] = {str(status): count for status, count in statuses.items()}
+    result['concurrency'] = concurrency
+    result['server_cpu_s'] = round(cpu_after - cpu_before, 4) if cpu_after is not None else None
+    result['server_peak_rss_mb'] = peak_rss
+    return result
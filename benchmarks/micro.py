@@ -0,0 +1,75 @@
+"""
+Microbenchmarks of the render pipeline stages, run in this process.
+
+Each benchmark times every call separately over the corpus prompts, with
+caches bypassed, so the numbers are the cost of the work itself.
+"""
+import base64
+import time
+
+from benchmarks.report import SelfUsage, summarize
+
+BATCH_SIZE = 64
+
+# Large tiled renders take seconds each, so only a few prompts are used
+TILED_SIZE = 4096
+TILED_PROMPTS = 10
+
+
+def _timed(fn, items):
+    latencies = []
+    errors = 0
+    start = time.perf_counter()
+    with SelfUsage() as usage:
+        for item in items:
+            call_start = time.perf_counter()
+            try:
+                fn(item)
+            except Exception:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - call_start)
+    result = summarize(latencies, time.perf_counter() - start, errors)
+    result['cpu_s'] = usage.cpu_s
+    return result
+
+
+def _timed_batches(fn, prompts, size):
+    # Latency is reported per image, so it compares directly with the
+    # single-image benchmarks
+    batches = [prompts[i:i + size] for i in range(0, len(prompts), size)]
+    latencies = []
+    start = time.perf_counter()
+    with SelfUsage() as usage:
+        for batch in batches:
+            call_start = time.perf_counter()
+            fn(batch)
+            latencies.extend([(time.perf_counter() - call_start) / len(batch)] * len(batch))
+    result = summarize(latencies, time.perf_counter() - start)
+    result['cpu_s'] = usage.cpu_s
+    return result
+
+
+def run(prompts):
+    """Run every microbenchmark over ``prompts`` and return their results."""
+    import app
+    import app_simple
+    import tiles
+    from encoding import encode_image
+    from rasterizer import generate_images
+
+    images = [app.generate_image(prompt) for prompt in prompts]
+    pngs = [encode_image(image, 'png') for image in images]
+
+    return {
+        'generate_image': _timed(app.generate_image, prompts),
+        f'generate_images_batch{BATCH_SIZE}': _timed_batches(generate_images, prompts, BATCH_SIZE),
+        'simple_draw_image': _timed(app_simple.draw_image, prompts),
+        'encode_png': _timed(lambda image: encode_image(image, 'png'), images),
+        'encode_webp': _timed(lambda image: encode_image(image, 'webp'), images),
+        'base64_png': _timed(base64.b64encode, pngs),
+        f'stream_png_{TILED_SIZE}': _timed(
+            lambda prompt: b''.join(tiles.stream_png(
+                app.prompt_shapes(prompt), TILED_SIZE, tiles.pyramid_levels(TILED_SIZE))),
+            prompts[:TILED_PROMPTS]),
+    }
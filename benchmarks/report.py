@@ -0,0 +1,93 @@
+"""
+Latency summaries and process resource readings for benchmark reports.
+"""
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 4) if seconds is not None else None
+
+
+def summarize(latencies, elapsed, errors=0):
+    """Summarise per-call latencies in seconds into a report entry in ms."""
+    values = sorted(latencies)
+    return {
+        'count': len(values),
+        'errors': errors,
+        'elapsed_s': round(elapsed, 4),
+        'per_s': round(len(values) / elapsed, 2) if elapsed else None,
+        'mean_ms': _ms(sum(values) / len(values)) if values else None,
+        'p50_ms': _ms(percentile(values, 0.50)),
+        'p95_ms': _ms(percentile(values, 0.95)),
+        'p99_ms': _ms(percentile(values, 0.99)),
+        'max_ms': _ms(values[-1]) if values else None,
+    }
+
+
+class SelfUsage:
+    """CPU seconds used by this process between start and stop."""
+
+    def __enter__(self):
+        self.start = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        self.cpu_s = round(time.process_time() - self.start, 4)
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process, in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 2)
+
+
+def process_usage(pid):
+    """CPU seconds and peak RSS in MiB of another process, read from /proc.
+
+    Returns Nones where /proc is not available.
+    """
+    cpu = rss = None
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            # Fields after the command name, which may contain spaces
+            fields = f.read().rsplit(')', 1)[1].split()
+        ticks = os.sysconf('SC_CLK_TCK')
+        cpu = round((int(fields[11]) + int(fields[12])) / ticks, 4)
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    rss = round(int(line.split()[1]) / 1024, 2)
+    except (OSError, ValueError, IndexError):
+        pass
+    return cpu, rss
+
+
+def environment():
+    """Describe where a report was produced, so reports can be matched up."""
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
@@ -0,0 +1,67 @@
+"""
+Run the benchmark suites and write a JSON report.
+
+    python -m benchmarks.run --corpus corpus.jsonl --out report.json
+    python -m benchmarks.run --suite micro --limit 200
+
+Without ``--corpus`` a corpus of ``--count`` prompts is generated with the
+given repeat ratio and rate, the same way ``benchmarks.corpus`` does.
+"""
+import argparse
+import json
+import sys
+
+from benchmarks import corpus, load, micro
+from benchmarks.report import environment, peak_rss_mb
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run image generator benchmarks')
+    parser.add_argument('--suite', action='append', choices=('micro', 'flask', 'simple'),
+                        help='suites to run (repeatable); default is all of them')
+    parser.add_argument('--corpus', help='JSONL corpus to replay')
+    parser.add_argument('--count', type=int, default=500, help='prompts to generate without --corpus')
+    parser.add_argument('--repeat-ratio', type=float, default=0.3)
+    parser.add_argument('--rate', type=float, default=None, help='arrival rate for a generated corpus')
+    parser.add_argument('--limit', type=int, default=None, help='use only the first N corpus entries')
+    parser.add_argument('--concurrency', type=int, default=8, help='client connections for load tests')
+    parser.add_argument('--page-only', action='store_true',
+                        help='in the flask load test, skip fetching the image each page links to')
+    parser.add_argument('--out', help='write the report here instead of stdout')
+    args = parser.parse_args(argv)
+
+    if args.corpus:
+        entries = corpus.load(args.corpus)
+    else:
+        entries = [(entry['at'], entry['prompt'])
+                   for entry in corpus.generate(args.count, args.repeat_ratio, rate=args.rate)]
+    if args.limit:
+        entries = entries[:args.limit]
+
+    suites = args.suite or ['micro', 'flask', 'simple']
+    report = {
+        'environment': environment(),
+        'corpus': corpus.describe(entries),
+        'results': {},
+    }
+    if 'micro' in suites:
+        # Distinct prompts only: repeats would just measure the same work again
+        prompts = list(dict.fromkeys(prompt for _, prompt in entries))
+        for name, result in micro.run(prompts).items():
+            report['results'][f'micro.{name}'] = result
+        report['micro_peak_rss_mb'] = peak_rss_mb()
+    for target in ('flask', 'simple'):
+        if target in suites:
+            report['results'][f'load.{target}'] = load.run(
+                target, entries, args.concurrency, not args.page_only)
+
+    text = json.dumps(report, indent=2) + '\n'
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Image encoding and format negotiation for the /image endpoint.
+
+Encoder settings come from the environment so deployments can trade CPU
+for bytes without code changes:
+
+- ``PNG_COMPRESS_LEVEL`` (0-9, default 6) and ``PNG_OPTIMIZE`` (0/1)
+- ``WEBP_QUALITY`` (0-100, default 80) and ``WEBP_LOSSLESS`` (0/1, default
+  1; the flat-colour images compress far better losslessly, and in that
+  mode quality trades encoding effort for size)
+- ``JPEG_QUALITY`` (0-95, default 75)
+"""
+import io
+import os
+
+import metrics
+from render_cache import cache_key
+
+# Media type per format, in the order preferred when a client accepts
+# several equally
+FORMATS = {
+    'webp': 'image/webp',
+    'png': 'image/png',
+    'jpeg': 'image/jpeg',
+}
+
+ENCODER_OPTIONS = {
+    'png': {
+        'compress_level': int(os.environ.get('PNG_COMPRESS_LEVEL', 6)),
+        'optimize': os.environ.get('PNG_OPTIMIZE', '0') == '1',
+    },
+    'webp': {
+        'quality': int(os.environ.get('WEBP_QUALITY', 80)),
+        'lossless': os.environ.get('WEBP_LOSSLESS', '1') == '1',
+    },
+    'jpeg': {
+        'quality': int(os.environ.get('JPEG_QUALITY', 75)),
+    },
+}
+
+
+def encode_image(image, fmt):
+    """Encode a PIL image as ``fmt`` with the configured options."""
+    with metrics.stage('encode'):
+        buffer = io.BytesIO()
+        image.save(buffer, format=fmt.upper(), **ENCODER_OPTIONS[fmt])
+        return buffer.getvalue()
+
+
+def encoded_key(key, fmt):
+    """Return the cache key of an image key encoded as ``fmt``.
+
+    The encoder options are part of the key, so changing them never serves
+    bytes encoded with the old ones.
+    """
+    return cache_key(key, format=fmt, **ENCODER_OPTIONS[fmt])
+
+
+def negotiate_format(accept):
+    """Pick the format to send for an Accept header value.
+
+    Returns None when the client accepts none of ``FORMATS``. A missing
+    header, or one that matches only through ``*/*`` or ``image/*`` as
+    curl and most HTTP libraries send, gets PNG as before; another format
+    is only picked when the client names it.
+    """
+    if not accept:
+        return 'png'
+
+    quality = {}
+    for item in accept.split(','):
+        media_type, *params = [part.strip() for part in item.split(';')]
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        quality[media_type.lower()] = q
+
+    best, best_rank = None, None
+    for fmt, media_type in FORMATS.items():
+        # The most specific range that matches decides, per RFC 9110
+        for candidate in (media_type, 'image/*', '*/*'):
+            if candidate in quality:
+                q = quality[candidate]
+                break
+        else:
+            continue
+        if q <= 0:
+            continue
+        # Among equal q values, a format named outright beats one matched
+        # by a wildcard, and PNG beats the other wildcard matches
+        explicit = candidate == media_type
+        rank = (q, explicit, not explicit and fmt == 'png')
+        if best_rank is None or rank > best_rank:
+            best, best_rank = fmt, rank
+    return best
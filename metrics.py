@@ -0,0 +1,296 @@
+"""
+Hot-path timers and counters, exposed in the Prometheus text format.
+
+Requests are wrapped in ``track_request`` and the work inside them in
+``stage``. Each stage feeds a histogram labelled by stage name and is also
+added to the breakdown of the request it runs for, even when it runs on
+another thread through ``contextvars``.
+
+Setting ``SLOW_REQUEST_LOG=N`` keeps the N slowest requests, with their
+prompt and stage breakdown, and logs them every ``SLOW_REQUEST_INTERVAL``
+seconds (default 60). ``SLOW_REQUEST_SAMPLE`` (0-1, default 1) limits that
+bookkeeping to a random share of requests.
+"""
+import bisect
+import contextlib
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds; request stages range from microseconds (base64 of a small PNG)
+# to whole seconds under load
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+_metrics = []
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._lock = threading.Lock()
+        # Registering a name again replaces the old metric, so the
+        # exposition never repeats a name
+        _metrics[:] = [metric for metric in _metrics if metric.name != name]
+        _metrics.append(self)
+
+    def _labels(self, value, extra=''):
+        parts = []
+        if self.label is not None:
+            parts.append(f'{self.label}="{_escape(value)}"')
+        if extra:
+            parts.append(extra)
+        return '{' + ','.join(parts) + '}' if parts else ''
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    """Monotonic count, optionally split by one label."""
+
+    type = 'counter'
+
+    def __init__(self, name, help, label=None):
+        super().__init__(name, help, label)
+        self._values = {}
+
+    def inc(self, amount=1, label_value=None):
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            values = sorted(self._values.items(), key=lambda item: str(item[0]))
+        return [f'{self.name}{self._labels(key)} {_format_value(value)}' for key, value in values]
+
+
+class Gauge(Counter):
+    """Value that goes up and down, optionally split by one label."""
+
+    type = 'gauge'
+
+    def dec(self, amount=1, label_value=None):
+        self.inc(-amount, label_value)
+
+
+class Histogram(_Metric):
+    """Cumulative-bucket histogram, optionally split by one label."""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, label=None, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, label)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._series = {}
+
+    def observe(self, value, label_value=None):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [[0] * len(self.buckets), 0.0, 0]
+            # Index of the first bound >= value, i.e. the bucket le= it falls in
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def _samples(self):
+        with self._lock:
+            series = sorted(
+                ((key, list(counts), total, count) for key, (counts, total, count) in self._series.items()),
+                key=lambda item: str(item[0]),
+            )
+        lines = []
+        for key, counts, total, count in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f'{self.name}_bucket{self._labels(key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{self._labels(key)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{self._labels(key)} {count}')
+        return lines
+
+
+class Callback(_Metric):
+    """Metric whose value is read from a function at scrape time."""
+
+    def __init__(self, name, help, type, fn):
+        super().__init__(name, help)
+        self.type = type
+        self.fn = fn
+
+    def _samples(self):
+        return [f'{self.name} {_format_value(self.fn())}']
+
+
+def render_text():
+    """Return every metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in list(_metrics):
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def register_cache(cache, prefix='imagegen_cache'):
+    """Export the counters of a RenderCache."""
+    counters = {
+        'hits': 'Lookups answered from memory.',
+        'disk_hits': 'Lookups answered from the on-disk tier.',
+        'misses': 'Lookups that found nothing.',
+        'evictions': 'Entries dropped to stay within the memory budget.',
+        'disk_evictions': 'Files deleted to stay within the disk budget.',
+        'coalesced': 'Renders saved by sharing an identical render in flight.',
+        'coalesce_timeouts': 'Requests that gave up waiting for a shared render.',
+    }
+    for field, help in counters.items():
+        Callback(f'{prefix}_{field}_total', help, 'counter', lambda field=field: cache.stats()[field])
+    Callback(f'{prefix}_bytes', 'Bytes held in memory.', 'gauge', lambda: cache.stats()['bytes'])
+    Callback(f'{prefix}_disk_bytes', 'Bytes held on disk.', 'gauge', lambda: cache.stats()['disk_bytes'])
+    Callback(f'{prefix}_entries', 'Entries held in memory.', 'gauge', lambda: cache.stats()['entries'])
+    Callback(f'{prefix}_renders_in_flight', 'Renders currently running.', 'gauge', cache.flights.in_flight)
+
+
+STAGE_SECONDS = Histogram(
+    'imagegen_stage_seconds', 'Time spent in each stage of serving a request.', 'stage')
+REQUEST_SECONDS = Histogram(
+    'imagegen_request_seconds', 'Time spent handling a request, by route.', 'route')
+REQUESTS_IN_FLIGHT = Gauge(
+    'imagegen_requests_in_flight', 'Requests currently being handled, by route.', 'route')
+RESPONSE_BYTES = Counter(
+    'imagegen_response_bytes_total', 'Response body bytes sent, by route.', 'route')
+
+
+class RequestTrace:
+    """What one request spent its time on."""
+
+    def __init__(self, route):
+        self.route = route
+        self.prompt = None
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def set_prompt(prompt):
+    """Attach a prompt to the request being handled, for the slow log."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.prompt = prompt
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Time a block as one stage of the current request."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, name)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(name, elapsed)
+
+
+@contextlib.contextmanager
+def track_request(route):
+    """Time a request, count it as in flight and feed the slow log."""
+    trace = RequestTrace(route)
+    token = _current_trace.set(trace)
+    REQUESTS_IN_FLIGHT.inc(1, route)
+    start = time.perf_counter()
+    try:
+        yield trace
+    finally:
+        elapsed = time.perf_counter() - start
+        REQUESTS_IN_FLIGHT.dec(1, route)
+        REQUEST_SECONDS.observe(elapsed, route)
+        _current_trace.reset(token)
+        if slow_requests is not None:
+            slow_requests.record(trace, elapsed)
+
+
+def count_bytes(route, amount):
+    RESPONSE_BYTES.inc(amount, route)
+
+
+class SlowRequestLog:
+    """Keep the slowest requests seen and log them periodically."""
+
+    def __init__(self, size, interval=60.0, sample=1.0):
+        self.size = size
+        self.interval = interval
+        self.sample = sample
+        self._heap = []
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+        self._last_dump = time.monotonic()
+
+    def record(self, trace, elapsed):
+        if self.sample < 1.0 and random.random() >= self.sample:
+            return
+        entry = (elapsed, next(self._order), trace)
+        with self._lock:
+            if len(self._heap) < self.size:
+                heapq.heappush(self._heap, entry)
+            elif elapsed > self._heap[0][0]:
+                heapq.heapreplace(self._heap, entry)
+            due = time.monotonic() - self._last_dump >= self.interval
+        if due:
+            self.dump()
+
+    def dump(self):
+        """Log the slowest requests since the last dump and start over."""
+        with self._lock:
+            entries, self._heap = sorted(self._heap, reverse=True), []
+            self._last_dump = time.monotonic()
+        for elapsed, _, trace in entries:
+            stages = ' '.join(f'{name}={seconds * 1000:.2f}ms' for name, seconds in sorted(trace.stages.items()))
+            logger.warning('slow request %.2fms %s prompt=%r %s',
+                           elapsed * 1000, trace.route, trace.prompt, stages)
+
+
+_slow_size = int(os.environ.get('SLOW_REQUEST_LOG', 0))
+slow_requests = SlowRequestLog(
+    _slow_size,
+    interval=float(os.environ.get('SLOW_REQUEST_INTERVAL', 60)),
+    sample=float(os.environ.get('SLOW_REQUEST_SAMPLE', 1)),
+) if _slow_size > 0 else None
@@ -0,0 +1,263 @@
+"""
+Content-addressed cache for encoded images.
+
+A cache key is a hash of the prompt together with every parameter that
+affects the output, so two requests with the same key always produce
+byte-identical images. That also makes the key usable as a strong ETag.
+"""
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+
+from single_flight import SingleFlight
+
+KEY_PATTERN = re.compile(r'[0-9a-f]{64}')
+
+
+def cache_key(prompt, **params):
+    """Return a stable hex key for a prompt and its render parameters."""
+    payload = json.dumps({'prompt': prompt, **params}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def is_cache_key(key):
+    """Check that ``key`` has the form ``cache_key`` returns."""
+    return KEY_PATTERN.fullmatch(key) is not None
+
+
+def make_etag(key):
+    """Return the quoted strong ETag for a cache key."""
+    return f'"{key}"'
+
+
+def etag_matches(if_none_match, etag):
+    """Check an If-None-Match header value against an ETag.
+
+    If-None-Match uses the weak comparison, so a W/ prefix on either side
+    is ignored.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    wanted = etag[2:] if etag.startswith('W/') else etag
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == wanted:
+            return True
+    return False
+
+
+class RenderCache:
+    """Byte-bounded LRU of encoded images with an optional on-disk tier.
+
+    The memory tier holds at most ``max_bytes`` of image data and evicts the
+    least recently used entries first. When ``disk_dir`` is given, every
+    rendered image is also written there and read back on a memory miss, so
+    the cache survives restarts and is shared by all processes pointing at
+    the same directory. With ``disk_max_bytes``, the files least recently
+    written or read are deleted once the directory grows past it.
+
+    Concurrent misses for the same key are coalesced: one caller renders
+    and the rest wait for its bytes.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, disk_dir=None, disk_max_bytes=None):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.flights = SingleFlight()
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        self._disk_size = 0
+        self._prune_lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._disk_size = sum(size for _, size, _ in self._disk_files())
+
+    def get(self, key):
+        """Return the cached bytes for ``key``, or None."""
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+
+        data = self._read_disk(key)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self._store(key, data)
+        return data
+
+    def put(self, key, data):
+        """Store ``data`` under ``key`` in memory and, if enabled, on disk."""
+        self._store(key, data)
+        self._write_disk(key, data)
+
+    def get_or_render(self, key, render, timeout=None):
+        """Return the bytes for ``key``, calling ``render()`` on a miss.
+
+        While one caller renders a key, others asking for it wait up to
+        ``timeout`` seconds for that render instead of starting their own,
+        then raise TimeoutError. An error from ``render`` is raised in every
+        waiting caller.
+        """
+        data = self.get(key)
+        if data is None:
+            data = self.flights.do(key, lambda: self._render(key, render), timeout)
+        return data
+
+    def _render(self, key, render):
+        # Another caller may have finished this key between our miss and
+        # taking the flight
+        with self._lock:
+            data = self._entries.get(key)
+        if data is None:
+            data = render()
+            self.put(key, data)
+        return data
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'disk_bytes': self._disk_size,
+                'disk_evictions': self.disk_evictions,
+                'coalesced': self.flights.coalesced,
+                'coalesce_timeouts': self.flights.timeouts,
+            }
+
+    def clear(self):
+        """Drop the memory tier. Files on disk are left alone."""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _store(self, key, data):
+        # Entries bigger than the whole budget would only evict everything else
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._entries[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+                self.evictions += 1
+
+    def _disk_path(self, key):
+        # Keys are hex digests; anything else could name a path outside
+        # the cache directory
+        if not is_cache_key(key):
+            raise ValueError(f'invalid cache key {key!r}')
+        return os.path.join(self.disk_dir, key[:2], key)
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        if not data:
+            return None
+        try:
+            # Reads count as use, so pruning drops the coldest files first
+            os.utime(path)
+        except OSError:
+            pass
+        return data
+
+    def _write_disk(self, key, data):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        if os.path.exists(path):
+            return
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # Write to a temporary file first so readers never see a partial image
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        with self._lock:
+            self._disk_size += len(data)
+            over = self.disk_max_bytes is not None and self._disk_size > self.disk_max_bytes
+        if over:
+            self._prune_disk()
+
+    def _disk_files(self):
+        # (mtime, size, path) of every cache file; temporary files of
+        # writes in progress are left alone
+        files = []
+        for directory, _, names in os.walk(self.disk_dir):
+            for name in names:
+                if not is_cache_key(name):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def _prune_disk(self):
+        # One thread prunes at a time; the others carry on writing
+        if not self._prune_lock.acquire(blocking=False):
+            return
+        try:
+            files = sorted(self._disk_files())
+            total = sum(size for _, size, _ in files)
+            # Prune below the budget so the next writes do not rescan the
+            # directory straight away. Other processes sharing it are
+            # counted too, because the size comes from the directory itself.
+            target = self.disk_max_bytes * 9 // 10
+            removed = 0
+            for _, size, path in files:
+                if total <= target:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                removed += 1
+            with self._lock:
+                self._disk_size = total
+                self.disk_evictions += removed
+        finally:
+            self._prune_lock.release()
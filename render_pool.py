@@ -0,0 +1,50 @@
+"""
+Bounded thread pool for CPU-heavy renders, with admission control.
+"""
+import concurrent.futures
+import contextvars
+import os
+import threading
+
+RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', os.cpu_count() or 1))
+RENDER_MAX_QUEUE = int(os.environ.get('RENDER_MAX_QUEUE', 4 * RENDER_WORKERS))
+
+
+class Overloaded(Exception):
+    """Raised when a RenderPool has no room for another render."""
+
+
+class RenderPool:
+    """Bounded thread pool for CPU-heavy renders.
+
+    At most ``workers`` renders run at once and ``max_queue`` more may wait;
+    beyond that ``run`` raises Overloaded straight away instead of letting
+    the backlog grow. Pillow releases the GIL while encoding, so threads
+    make real progress in parallel.
+    """
+
+    def __init__(self, workers=RENDER_WORKERS, max_queue=RENDER_MAX_QUEUE):
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='render')
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+
+    def run(self, fn, *args):
+        """Run fn(*args) on the pool and return its result."""
+        return self.submit(fn, *args).result()
+
+    def submit(self, fn, *args):
+        """Start fn(*args) on the pool and return its Future."""
+        if not self._slots.acquire(blocking=False):
+            raise Overloaded()
+        try:
+            # Run in a copy of our context so the render's stage timings
+            # are added to the request that asked for it
+            future = self._executor.submit(contextvars.copy_context().run, fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,30 @@
+"""
+Prompt seeds for the image renderers.
+
+Version 1 is the original seed, the sum of the prompt's character codes.
+It maps anagrams, and many unrelated prompts, to the same image. Version 2
+hashes the prompt instead. The version in use is part of every cache key,
+so images from the two schemes never mix. Set ``SEED_VERSION=1`` to keep
+rendering the images produced before version 2 existed.
+"""
+import hashlib
+import os
+
+LEGACY_SEED = 1
+HASH_SEED = 2
+
+SEED_VERSION = int(os.environ.get('SEED_VERSION', HASH_SEED))
+
+
+def prompt_seed(prompt, version=None):
+    """Return the integer seed for a prompt under a seed version.
+
+    Hash seeds are 64-bit; legacy seeds are small non-negative integers.
+    """
+    version = SEED_VERSION if version is None else version
+    if version == LEGACY_SEED:
+        return sum(ord(c) for c in prompt)
+    if version == HASH_SEED:
+        digest = hashlib.blake2b(prompt.encode('utf-8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'big')
+    raise ValueError(f'unknown seed version: {version}')
@@ -0,0 +1,95 @@
+"""
+Request coalescing for identical work in flight.
+
+When many threads ask for the same key at once, only the first one runs
+the function; the others wait for it and share its result or its error.
+"""
+import threading
+
+
+class Flight:
+    """One call for a key, run by the thread that claimed it."""
+
+    def __init__(self, flights, key):
+        self._flights = flights
+        self.key = key
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def resolve(self, result=None, error=None):
+        """Publish the outcome to the waiters; the leader must call this once."""
+        self._result = result
+        self._error = error
+        with self._flights._lock:
+            del self._flights._calls[self.key]
+        self._done.set()
+
+    def wait(self, timeout=None):
+        """Return the leader's result, or raise its error.
+
+        Raises TimeoutError if the leader has not finished within
+        ``timeout`` seconds. The leader itself is never interrupted.
+        """
+        if not self._done.wait(timeout):
+            with self._flights._lock:
+                self._flights.timeouts += 1
+            raise TimeoutError(f'timed out waiting for in-flight call for {self.key!r}')
+        if self._error is not None:
+            raise self._error
+        # Only a waiter that gets the shared result saved a render
+        with self._flights._lock:
+            self._flights.coalesced += 1
+        return self._result
+
+
+class SingleFlight:
+    """Run at most one call per key at a time, sharing the outcome.
+
+    ``coalesced`` counts the calls that were answered by another thread's
+    work instead of running their own, and ``timeouts`` the waiters that
+    gave up.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+        self.timeouts = 0
+
+    def claim(self, key):
+        """Return ``(flight, leader)`` for ``key``.
+
+        The leader runs the work itself and must ``resolve`` the flight;
+        everyone else calls ``flight.wait``. This suits work that does not
+        fit in one function call, such as a response streamed while it is
+        rendered.
+        """
+        with self._lock:
+            flight = self._calls.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._calls[key] = Flight(self, key)
+        return flight, leader
+
+    def do(self, key, fn, timeout=None):
+        """Return ``fn()``, or the result of a call for ``key`` already running.
+
+        Waiters raise whatever the running call raised, and TimeoutError if
+        it has not finished within ``timeout`` seconds. The running call
+        itself is never interrupted.
+        """
+        flight, leader = self.claim(key)
+        if not leader:
+            return flight.wait(timeout)
+        try:
+            result = fn()
+        except BaseException as exc:
+            flight.resolve(error=exc)
+            raise
+        flight.resolve(result)
+        return result
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
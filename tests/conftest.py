@@ -0,0 +1,29 @@
+import os
+import sys
+import threading
+
+import pytest
+
+# The modules live at the top of the repository, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def flask_client():
+    import app
+    return app.app.test_client()
+
+
+@pytest.fixture
+def simple_server():
+    """Serve app_simple on a free port; yields the server."""
+    import app_simple
+    server = app_simple.PooledHTTPServer(
+        ('127.0.0.1', 0), app_simple.ImageGeneratorHandler, workers=4, max_queue=4,
+        render_pool=app_simple.RenderPool(2, 2))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.graceful_shutdown()
+    thread.join()
+    server.server_close()
@@ -0,0 +1,126 @@
+import base64
+import html
+import http.client
+import json
+import re
+import threading
+import urllib.parse
+
+import app
+import app_simple
+
+
+def test_servers_key_their_images_apart():
+    # The servers draw different images for a prompt, so a cache directory
+    # shared by both must not serve one's image for the other
+    assert app.image_key('cat') != app_simple.image_key('cat')
+    assert app.render_png('cat') != app_simple.generate_png('cat')
+
+
+def image_url(client, prompt):
+    page = client.post('/', data={'prompt': prompt}).get_data(as_text=True)
+    return html.unescape(re.search(r'<img src="([^"]+)"', page).group(1))
+
+
+def test_index_links_to_the_image_without_revalidating(flask_client):
+    response = flask_client.post('/', data={'prompt': 'etag page'}, headers={'If-None-Match': '*'})
+    assert response.status_code == 200
+    assert response.headers.get('ETag') is None
+    assert app.image_key('etag page') in response.get_data(as_text=True)
+
+
+def test_image_answers_if_none_match_with_304(flask_client):
+    url = image_url(flask_client, 'etag image')
+    response = flask_client.get(url)
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    assert etag.strip('"') != app.image_key('etag image')
+
+    for header in (etag, 'W/' + etag, '"other", ' + etag):
+        revalidated = flask_client.get(url, headers={'If-None-Match': header})
+        assert revalidated.status_code == 304
+        assert revalidated.headers['ETag'] == etag
+        assert revalidated.data == b''
+    assert flask_client.get(url, headers={'If-None-Match': '"other"'}).status_code == 200
+
+
+def test_image_etag_depends_on_format(flask_client):
+    url = image_url(flask_client, 'etag format')
+    png = flask_client.get(url, headers={'Accept': 'image/png'})
+    webp = flask_client.get(url, headers={'Accept': 'image/webp'})
+    assert png.mimetype == 'image/png' and webp.mimetype == 'image/webp'
+    assert png.headers['ETag'] != webp.headers['ETag']
+    assert 'Accept' in png.headers['Vary']
+
+
+def test_simple_generate_answers_if_none_match_with_304(simple_server):
+    conn = http.client.HTTPConnection(*simple_server.server_address)
+    conn.request('GET', '/generate?prompt=etag+simple')
+    response = conn.getresponse()
+    body = json.loads(response.read())
+    assert response.status == 200
+    assert body['url'].startswith('/image/' + app_simple.image_key('etag simple'))
+    etag = response.getheader('ETag')
+
+    conn.request('GET', '/generate?prompt=etag+simple', headers={'If-None-Match': etag})
+    response = conn.getresponse()
+    assert response.status == 304
+    assert response.read() == b''
+
+    conn.request('GET', body['url'], headers={'Accept': 'image/png'})
+    response = conn.getresponse()
+    assert response.status == 200
+    assert response.read() == base64.b64decode(body['image'])
+    conn.close()
+
+
+def test_simple_routes_generate_paths_exactly(simple_server):
+    conn = http.client.HTTPConnection(*simple_server.server_address)
+    conn.request('GET', '/generate/batch')
+    response = conn.getresponse()
+    response.read()
+    assert response.status == 405
+    assert response.getheader('Allow') == 'POST'
+
+    conn.request('GET', '/generatex?prompt=a')
+    response = conn.getresponse()
+    response.read()
+    assert response.status == 404
+    conn.close()
+
+
+def test_simple_generate_answers_503_when_the_render_pool_is_full(simple_server):
+    pool = app_simple.RenderPool(1, 0)
+    release = threading.Event()
+    pool.submit(release.wait, 5)
+    simple_server.render_pool, original = pool, simple_server.render_pool
+    try:
+        conn = http.client.HTTPConnection(*simple_server.server_address)
+        conn.request('GET', '/generate?prompt=no+room+for+this')
+        response = conn.getresponse()
+        response.read()
+        assert response.status == 503
+        assert response.getheader('Retry-After') == str(app_simple.RETRY_AFTER)
+        conn.close()
+    finally:
+        simple_server.render_pool = original
+        release.set()
+        pool.shutdown()
+
+
+def test_overlong_prompts_are_refused_with_400(flask_client, simple_server):
+    prompt = 'é' * (app.MAX_PROMPT_BYTES // 2 + 1)
+    # Error bodies count as streamed, so close them to end their metrics
+    with flask_client.post('/', data={'prompt': prompt}) as response:
+        assert response.status_code == 400
+        assert str(app.MAX_PROMPT_BYTES) in response.get_data(as_text=True)
+    with flask_client.get(f'/image/{app.image_key(prompt)}', query_string={'prompt': prompt}) as response:
+        assert response.status_code == 400
+
+    conn = http.client.HTTPConnection(*simple_server.server_address)
+    for path in ('/generate?inline=0&prompt=', f'/image/{app_simple.image_key(prompt)}?prompt='):
+        conn.request('GET', path + urllib.parse.quote(prompt))
+        response = conn.getresponse()
+        response.read()
+        assert response.status == 400
+    conn.close()
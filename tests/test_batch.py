@@ -0,0 +1,84 @@
+import base64
+import concurrent.futures
+import json
+import threading
+
+import pytest
+
+from batch import parse_prompts, stream_batch
+from render_cache import RenderCache
+
+
+def render(prompt):
+    if prompt == 'boom':
+        raise ValueError('bad prompt')
+    return prompt.encode('utf-8')
+
+
+def lines(results):
+    return sorted((json.loads(line) for line in results), key=lambda line: line['index'])
+
+
+@pytest.fixture
+def executor():
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        yield executor
+
+
+def test_parse_prompts():
+    assert parse_prompts(b'["a", "b"]') == ['a', 'b']
+    assert parse_prompts(b'{"prompts": ["a"]}') == ['a']
+    with pytest.raises(ValueError):
+        parse_prompts(b'{"prompt": "a"}')
+    with pytest.raises(ValueError):
+        parse_prompts(b'not json')
+
+
+def test_errors_are_reported_inline(executor):
+    results = lines(stream_batch(['ok', 42, 'boom'], render, executor=executor))
+    assert base64.b64decode(results[0]['image']) == b'ok'
+    assert results[1] == {'index': 1, 'prompt': 42, 'error': 'prompt must be a string'}
+    assert results[2]['error'] == 'ValueError: bad prompt'
+
+
+def test_cached_and_repeated_prompts_skip_the_pool(executor):
+    cache = RenderCache(max_bytes=1024)
+    cache.put('key-cached', b'from cache')
+    submitted = []
+    original = executor.submit
+
+    def submit(fn, prompt):
+        submitted.append(prompt)
+        return original(fn, prompt)
+
+    executor.submit = submit
+    results = lines(stream_batch(['cached', 'new', 'new'], render, cache,
+                                 lambda prompt: f'key-{prompt}', executor=executor))
+    assert [base64.b64decode(line['image']) for line in results] == [b'from cache', b'new', b'new']
+    assert submitted == ['new']
+    assert cache.get('key-new') == b'new'
+
+
+def test_closing_early_cancels_queued_renders():
+    tokens = threading.Semaphore(0)
+
+    def slow(prompt):
+        tokens.acquire(timeout=5)
+        return b'png'
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        submitted = []
+        original = executor.submit
+
+        def submit(fn, prompt):
+            submitted.append(original(fn, prompt))
+            return submitted[-1]
+
+        executor.submit = submit
+        results = stream_batch(['a', 'b', 'c'], slow, executor=executor, max_pending=3)
+        # Let only the first render finish, then close while 'c' is queued
+        tokens.release()
+        next(results)
+        results.close()
+        assert submitted[2].cancelled()
+        tokens.release()
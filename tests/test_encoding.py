@@ -0,0 +1,25 @@
+import pytest
+
+from encoding import negotiate_format
+
+
+@pytest.mark.parametrize('accept, expected', [
+    (None, 'png'),
+    ('', 'png'),
+    ('*/*', 'png'),
+    ('image/*', 'png'),
+    ('image/webp', 'webp'),
+    ('image/avif,image/webp,image/apng,image/*,*/*;q=0.8', 'webp'),
+    ('image/webp, image/png', 'webp'),
+    ('image/png, image/jpeg', 'png'),
+    ('image/jpeg, */*;q=0.5', 'jpeg'),
+    ('image/jpeg;q=0.5, */*', 'png'),
+    ('image/webp;q=0, */*', 'png'),
+    ('image/png;q=0, image/*', 'webp'),
+    ('IMAGE/JPEG', 'jpeg'),
+    ('image/png;q=abc, image/jpeg;q=0.1', 'jpeg'),
+    ('text/html', None),
+    ('image/gif', None),
+])
+def test_negotiate_format(accept, expected):
+    assert negotiate_format(accept) == expected
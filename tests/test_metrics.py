@@ -0,0 +1,40 @@
+import pytest
+
+import metrics
+
+
+@pytest.fixture
+def histogram():
+    histogram = metrics.Histogram('test_seconds', 'Test histogram.', 'stage', buckets=(0.1, 1.0))
+    yield histogram
+    metrics._metrics.remove(histogram)
+
+
+def test_render_text_writes_cumulative_buckets_sum_and_count(histogram):
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value, 'draw')
+
+    lines = metrics.render_text().splitlines()
+    start = lines.index('# HELP test_seconds Test histogram.')
+    assert lines[start:start + 7] == [
+        '# HELP test_seconds Test histogram.',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{stage="draw",le="0.1"} 2',
+        'test_seconds_bucket{stage="draw",le="1.0"} 3',
+        'test_seconds_bucket{stage="draw",le="+Inf"} 4',
+        'test_seconds_sum{stage="draw"} 2.65',
+        'test_seconds_count{stage="draw"} 4',
+    ]
+
+
+def test_stages_are_added_to_the_request_trace():
+    outer = metrics.current_trace()
+    with metrics.track_request('/test') as trace:
+        metrics.set_prompt('a prompt')
+        with metrics.stage('encode'):
+            pass
+        with metrics.stage('encode'):
+            pass
+    assert trace.prompt == 'a prompt'
+    assert list(trace.stages) == ['encode']
+    assert metrics.current_trace() is outer
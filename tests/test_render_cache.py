@@ -0,0 +1,113 @@
+import os
+
+import pytest
+
+from render_cache import RenderCache, cache_key, etag_matches, is_cache_key, make_etag
+
+
+def test_cache_key_is_stable_and_depends_on_params():
+    key = cache_key('sunset', size=(400, 400), version=1)
+    assert key == cache_key('sunset', version=1, size=(400, 400))
+    assert key != cache_key('sunset', size=(400, 400), version=2)
+    assert is_cache_key(key)
+
+
+@pytest.mark.parametrize('key', ['', '/tmp/secret', '../' + 'a' * 61, 'A' * 64, 'a' * 63, 'a' * 65])
+def test_is_cache_key_rejects_non_digests(key):
+    assert not is_cache_key(key)
+
+
+def test_lru_evicts_least_recently_used():
+    cache = RenderCache(max_bytes=30)
+    cache.put('a', b'x' * 10)
+    cache.put('b', b'x' * 10)
+    cache.put('c', b'x' * 10)
+    assert cache.get('a') is not None
+    cache.put('d', b'x' * 10)
+
+    assert cache.get('b') is None
+    for key in 'acd':
+        assert cache.get(key) is not None
+    assert cache.stats()['evictions'] == 1
+    assert cache.stats()['bytes'] == 30
+
+
+def test_entries_larger_than_the_cache_are_not_kept():
+    cache = RenderCache(max_bytes=10)
+    cache.put('small', b'x' * 5)
+    cache.put('big', b'x' * 11)
+    assert cache.get('big') is None
+    assert cache.get('small') == b'x' * 5
+
+
+def test_disk_tier_round_trip(tmp_path):
+    key = cache_key('disk')
+    RenderCache(max_bytes=1024, disk_dir=str(tmp_path)).put(key, b'png bytes')
+
+    # A new cache, as after a restart, reads the entry back from disk
+    cache = RenderCache(max_bytes=1024, disk_dir=str(tmp_path))
+    assert cache.get(key) == b'png bytes'
+    assert cache.stats()['disk_hits'] == 1
+    assert cache.get(key) == b'png bytes'
+    assert cache.stats()['hits'] == 1
+    assert not [name for name in os.listdir(tmp_path / key[:2]) if name != key]
+
+
+def test_disk_tier_refuses_paths(tmp_path):
+    secret = tmp_path / 'secret'
+    secret.write_bytes(b'token')
+    cache = RenderCache(max_bytes=1024, disk_dir=str(tmp_path / 'cache'))
+    with pytest.raises(ValueError):
+        cache.get(str(secret))
+
+
+def test_get_or_render_renders_once():
+    cache = RenderCache(max_bytes=1024)
+    calls = []
+
+    def render():
+        calls.append(1)
+        return b'image'
+
+    assert cache.get_or_render('k', render) == b'image'
+    assert cache.get_or_render('k', render) == b'image'
+    assert len(calls) == 1
+
+
+@pytest.mark.parametrize('header, expected', [
+    (None, False),
+    ('', False),
+    ('*', True),
+    ('"abc"', True),
+    ('W/"abc"', True),
+    ('"xyz", "abc"', True),
+    ('"xyz"', False),
+    ('abc', False),
+])
+def test_etag_matches(header, expected):
+    assert etag_matches(header, make_etag('abc')) is expected
+
+
+def test_disk_tier_prunes_the_coldest_files(tmp_path):
+    cache = RenderCache(max_bytes=1024, disk_dir=str(tmp_path), disk_max_bytes=100)
+    keys = [cache_key(str(i)) for i in range(4)]
+    for index, key in enumerate(keys[:3]):
+        cache.put(key, b'x' * 30)
+        # Spread the modification times, which order the pruning
+        os.utime(cache._disk_path(key), (index, index))
+    cache.clear()
+    # Reading the oldest file makes it the most recently used
+    assert cache.get(keys[0]) is not None
+    cache.put(keys[3], b'x' * 30)
+
+    stats = cache.stats()
+    assert stats['disk_bytes'] <= 90
+    assert stats['disk_evictions'] == 1
+    assert not os.path.exists(cache._disk_path(keys[1]))
+    for key in (keys[0], keys[2], keys[3]):
+        assert os.path.exists(cache._disk_path(key))
+
+
+def test_disk_size_counts_existing_files(tmp_path):
+    RenderCache(disk_dir=str(tmp_path)).put(cache_key('old'), b'x' * 40)
+    assert RenderCache(disk_dir=str(tmp_path)).stats()['disk_bytes'] == 40
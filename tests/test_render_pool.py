@@ -0,0 +1,20 @@
+import threading
+
+import pytest
+
+from render_pool import Overloaded, RenderPool
+
+
+def test_full_pool_refuses_work_until_a_slot_frees():
+    pool = RenderPool(workers=1, max_queue=1)
+    release = threading.Event()
+    running = pool.submit(release.wait, 5)
+    queued = pool.submit(release.wait, 5)
+    with pytest.raises(Overloaded):
+        pool.submit(release.wait, 5)
+
+    release.set()
+    running.result()
+    queued.result()
+    assert pool.run(sum, [1, 2]) == 3
+    pool.shutdown()
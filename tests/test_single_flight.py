@@ -0,0 +1,76 @@
+import threading
+
+import pytest
+
+from single_flight import SingleFlight
+
+
+def start_leader(flights, key, result=None, error=None):
+    """Start a call for ``key`` that finishes when the returned event is set."""
+    started = threading.Event()
+    release = threading.Event()
+    outcome = {}
+
+    def fn():
+        started.set()
+        release.wait(5)
+        if error is not None:
+            raise error
+        return result
+
+    def run():
+        try:
+            outcome['result'] = flights.do(key, fn)
+        except Exception as exc:
+            outcome['error'] = exc
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    started.wait(5)
+    return release, thread, outcome
+
+
+def test_waiters_get_the_result_of_the_running_call():
+    flights = SingleFlight()
+    release, leader, leader_outcome = start_leader(flights, 'k', result='shared')
+    flight, is_leader = flights.claim('k')
+    assert not is_leader
+    release.set()
+    assert flight.wait(5) == 'shared'
+    leader.join(5)
+    assert leader_outcome['result'] == 'shared'
+    assert flights.coalesced == 1
+
+
+def test_waiters_get_the_error_of_the_running_call():
+    flights = SingleFlight()
+    release, leader, outcome = start_leader(flights, 'k', error=RuntimeError('boom'))
+    flight, _ = flights.claim('k')
+    release.set()
+    with pytest.raises(RuntimeError, match='boom'):
+        flight.wait(5)
+    leader.join(5)
+    assert isinstance(outcome['error'], RuntimeError)
+    assert flights.coalesced == 0
+    assert flights.in_flight() == 0
+
+
+def test_waiters_time_out_without_stopping_the_call():
+    flights = SingleFlight()
+    release, leader, outcome = start_leader(flights, 'k', result='late')
+    with pytest.raises(TimeoutError):
+        flights.do('k', lambda: 'own work', timeout=0.01)
+    release.set()
+    leader.join(5)
+
+    assert outcome['result'] == 'late'
+    assert flights.timeouts == 1
+    assert flights.coalesced == 0
+
+
+def test_keys_do_not_share():
+    flights = SingleFlight()
+    release, leader, _ = start_leader(flights, 'a', result='a')
+    assert flights.do('b', lambda: 'b') == 'b'
+    release.set()
+    leader.join(5)
@@ -0,0 +1,123 @@
+import io
+
+import pytest
+from PIL import Image
+
+import tiles
+from render_cache import RenderCache
+from render_pool import Overloaded
+from tiles import CIRCLE, RECTANGLE
+
+SHAPES = [
+    (RECTANGLE, 200, 30, 30, 10, 20, 90),
+    (CIRCLE, 30, 200, 30, 150, 150, 99),
+    (CIRCLE, 30, 30, 200, 390, 5, 60),
+    (RECTANGLE, 90, 90, 90, 350, 380, 40),
+]
+
+
+def decode(png):
+    image = Image.open(io.BytesIO(png))
+    image.load()
+    return image
+
+
+@pytest.mark.parametrize('size', [1, 400, 401, 777])
+def test_bands_assemble_into_the_whole_image(size):
+    whole = tiles.draw_image(SHAPES, size)
+    assembled = Image.new('RGB', (size, size))
+    for index, band in enumerate(tiles.iter_bands(SHAPES, size, 97)):
+        assembled.paste(band, (0, index * 97))
+    assert assembled.tobytes() == whole.tobytes()
+
+
+def test_png_stream_decodes_to_the_bands():
+    size, rows = 300, 64
+    stream = tiles.PngStream(size, size)
+    png = stream.header()
+    for band in tiles.iter_bands(SHAPES, size, rows):
+        png += stream.write(band.tobytes())
+    png += stream.finish()
+
+    image = decode(png)
+    assert image.mode == 'RGB'
+    assert image.tobytes() == tiles.draw_image(SHAPES, size).tobytes()
+
+
+def test_png_stream_checks_the_row_count():
+    stream = tiles.PngStream(4, 4)
+    stream.write(bytes(4 * 3 * 3))
+    with pytest.raises(ValueError):
+        stream.finish()
+
+
+def test_stream_png_and_pyramid_levels():
+    size = 1024
+    levels = {}
+    png = b''.join(tiles.stream_png(SHAPES, size, tiles.pyramid_levels(size), levels.__setitem__))
+
+    whole = tiles.draw_image(SHAPES, size)
+    assert decode(png).tobytes() == whole.tobytes()
+    assert sorted(levels) == [1, 2]
+    reduced = whole
+    for level in sorted(levels):
+        reduced = reduced.reduce(2)
+        assert decode(levels[level]).tobytes() == reduced.tobytes()
+
+
+def test_scale_one_keeps_the_layout():
+    assert tiles._scale_box(10, 20, 30, 1.0) == (10, 20, 40, 50)
+    assert tiles.output_size(scale=2) == 800
+    with pytest.raises(ValueError):
+        tiles.output_size(tiles.MAX_SIZE + 1)
+
+
+def test_tiled_png_streams_then_serves_from_cache():
+    cache = RenderCache(max_bytes=16 * 1024 * 1024)
+    key = 'a' * 64
+    first = tiles.tiled_png(cache, key, SHAPES, 512)
+    assert not isinstance(first, bytes)
+    png = b''.join(first)
+    assert decode(png).size == (512, 512)
+
+    assert tiles.tiled_png(cache, key, SHAPES, 512) == png
+    assert decode(tiles.tiled_png(cache, key, SHAPES, 512, level=1)).size == (256, 256)
+
+
+def test_tiled_png_level_request_caches_the_full_image():
+    cache = RenderCache(max_bytes=16 * 1024 * 1024)
+    key = 'b' * 64
+    level = tiles.tiled_png(cache, key, SHAPES, 1024, level=2)
+    assert decode(level).size == (256, 256)
+    assert isinstance(tiles.tiled_png(cache, key, SHAPES, 1024), bytes)
+
+
+def test_tiled_png_rechecks_the_cache_after_claiming():
+    class LateCache(RenderCache):
+        # Misses the first lookup, as if a render finished just after it
+        def get(self, key):
+            if not getattr(self, 'looked', False):
+                self.looked = True
+                return None
+            return super().get(key)
+
+    cache = LateCache(max_bytes=1024)
+    key = 'c' * 64
+    cache.put(tiles.tiled_key(key, 512), b'png')
+
+    def submit(fn):
+        raise AssertionError('rendered again')
+
+    assert tiles.tiled_png(cache, key, SHAPES, 512, submit=submit) == b'png'
+    assert cache.flights.in_flight() == 0
+
+
+def test_tiled_png_refused_render_releases_the_flight():
+    cache = RenderCache(max_bytes=1024)
+
+    def submit(fn):
+        raise Overloaded()
+
+    with pytest.raises(Overloaded):
+        tiles.tiled_png(cache, 'd' * 64, SHAPES, 512, submit=submit)
+    assert cache.flights.in_flight() == 0
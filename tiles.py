@@ -0,0 +1,293 @@
+"""
+Tiled rendering for large output sizes.
+
+Shapes are laid out on the 400x400 base canvas and scaled to the output
+size. The image is drawn one horizontal band at a time, and every band is
+compressed into the PNG before the next one is drawn. Peak memory is
+therefore one band, whatever the resolution, and the PNG can be sent to
+the client while it is still being produced.
+
+The same bands also feed a pyramid of smaller levels (half, quarter, ...
+size). Each level is encoded alongside the full image, so thumbnails come
+out of one render instead of one render each.
+"""
+import os
+import queue
+import struct
+import threading
+import zlib
+
+from PIL import Image, ImageDraw
+
+import metrics
+from encoding import ENCODER_OPTIONS
+from render_cache import cache_key
+from render_pool import RenderPool
+
+BASE_SIZE = 400
+MAX_SIZE = int(os.environ.get('MAX_IMAGE_SIZE', 16384))
+
+# Bytes of raw pixels drawn at once
+BAND_BYTES = 8 * 1024 * 1024
+
+# Pyramid levels stop before going below this size
+PYRAMID_MIN_SIZE = 256
+
+RECTANGLE, CIRCLE = 0, 1
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def output_size(size=None, scale=None):
+    """Return the output size in pixels for a size or a scale of the base canvas."""
+    if size is None:
+        size = BASE_SIZE if scale is None else int(BASE_SIZE * scale + 0.5)
+    if not 1 <= size <= MAX_SIZE:
+        raise ValueError(f'size must be between 1 and {MAX_SIZE}')
+    return size
+
+
+def pyramid_levels(size):
+    """Number of halvings available below ``size``."""
+    levels = 0
+    while size % (2 << levels) == 0 and size >> (levels + 1) >= PYRAMID_MIN_SIZE:
+        levels += 1
+    return levels
+
+
+def tiled_key(key, size, level=0):
+    """Return the cache key of an image key rendered at ``size``, pyramid ``level``."""
+    return cache_key(key, format='png', size=size, level=level,
+                     compress_level=ENCODER_OPTIONS['png']['compress_level'])
+
+
+def _scale_box(x, y, extent, scale):
+    # The base canvas box covers pixels x..x+extent inclusive; scale its
+    # outer edges and keep the result inclusive, so scale 1 is unchanged
+    return (
+        int(x * scale + 0.5),
+        int(y * scale + 0.5),
+        int((x + extent + 1) * scale + 0.5) - 1,
+        int((y + extent + 1) * scale + 0.5) - 1,
+    )
+
+
+def draw_band(shapes, size, top, height):
+    """Draw rows ``top`` to ``top + height`` of the image at ``size``.
+
+    ``shapes`` are (kind, red, green, blue, x, y, extent) rows on the base
+    canvas, in drawing order.
+    """
+    scale = size / BASE_SIZE
+    band = Image.new('RGB', (size, height), color='white')
+    draw = ImageDraw.Draw(band)
+    for kind, red, green, blue, x, y, extent in shapes:
+        x0, y0, x1, y1 = _scale_box(x, y, extent, scale)
+        if y1 < top or y0 >= top + height:
+            continue
+        # Pillow clips shapes to the band, and its shapes do not depend on
+        # where they sit, so drawing shifted gives the rows of the full image
+        box = [x0, y0 - top, x1, y1 - top]
+        if kind == RECTANGLE:
+            draw.rectangle(box, fill=(red, green, blue))
+        else:
+            draw.ellipse(box, fill=(red, green, blue))
+    return band
+
+
+def draw_image(shapes, size=BASE_SIZE):
+    """Draw a whole image at ``size`` in one piece."""
+    return draw_band(shapes, size, 0, size)
+
+
+def iter_bands(shapes, size, rows):
+    """Yield the image at ``size`` as bands of ``rows`` rows, top to bottom."""
+    for top in range(0, size, rows):
+        with metrics.stage('draw'):
+            band = draw_band(shapes, size, top, min(rows, size - top))
+        yield band
+
+
+def _chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+class PngStream:
+    """Incremental PNG encoder for 8-bit RGB images.
+
+    Rows go in with ``write`` and come out as IDAT chunks right away, so
+    only the compressor state is held between calls.
+    """
+
+    def __init__(self, width, height, compress_level=6, flush=True):
+        self.width = width
+        self.height = height
+        self.flush = flush
+        self._compressor = zlib.compressobj(compress_level)
+        self._rows = 0
+
+    def header(self):
+        ihdr = struct.pack('>IIBBBBB', self.width, self.height, 8, 2, 0, 0, 0)
+        return PNG_SIGNATURE + _chunk(b'IHDR', ihdr)
+
+    def write(self, pixels):
+        """Compress whole rows of packed RGB bytes and return the chunk ready."""
+        stride = self.width * 3
+        count = len(pixels) // stride
+        view = memoryview(pixels)
+        # Every scanline starts with its filter type; 0 leaves it unfiltered
+        scanlines = bytearray(count * (stride + 1))
+        for row in range(count):
+            start = row * (stride + 1) + 1
+            scanlines[start:start + stride] = view[row * stride:(row + 1) * stride]
+        self._rows += count
+
+        data = self._compressor.compress(scanlines)
+        if self.flush:
+            # Push the band out now rather than when zlib's buffer fills
+            data += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        return _chunk(b'IDAT', data) if data else b''
+
+    def finish(self):
+        if self._rows != self.height:
+            raise ValueError(f'wrote {self._rows} rows of {self.height}')
+        data = self._compressor.flush()
+        return (_chunk(b'IDAT', data) if data else b'') + _chunk(b'IEND', b'')
+
+
+def stream_png(shapes, size, levels=0, on_level=None, compress_level=None):
+    """Yield the PNG of the image at ``size`` in chunks, band by band.
+
+    With ``levels``, the image at half, quarter, ... size is encoded from
+    the same bands, and ``on_level(level, png)`` is called with each one
+    once the full image is done.
+    """
+    if compress_level is None:
+        compress_level = ENCODER_OPTIONS['png']['compress_level']
+    if size % (1 << levels):
+        raise ValueError(f'size {size} cannot be halved {levels} times')
+
+    factor = 1 << levels
+    rows = max(1, BAND_BYTES // (size * 3)) // factor * factor or factor
+    stream = PngStream(size, size, compress_level)
+    pyramid = [PngStream(size >> level, size >> level, compress_level, flush=False)
+               for level in range(1, levels + 1)]
+    pyramid_chunks = [[level_stream.header()] for level_stream in pyramid]
+
+    yield stream.header()
+    for band in iter_bands(shapes, size, rows):
+        with metrics.stage('encode'):
+            chunk = stream.write(band.tobytes())
+            # Each level is the previous one halved, so every level costs
+            # a quarter of the one above it
+            reduced = band
+            for level_stream, chunks in zip(pyramid, pyramid_chunks):
+                reduced = reduced.reduce(2)
+                chunks.append(level_stream.write(reduced.tobytes()))
+        if chunk:
+            yield chunk
+    yield stream.finish()
+
+    for level, (level_stream, chunks) in enumerate(zip(pyramid, pyramid_chunks), 1):
+        chunks.append(level_stream.finish())
+        if on_level is not None:
+            on_level(level, b''.join(chunks))
+
+
+def render_pyramid(shapes, size, emit=None):
+    """Render the image at ``size`` and its pyramid; return {level: png}.
+
+    Level 0 is the full-size image. ``emit`` is called with each chunk of
+    it as soon as it is encoded.
+    """
+    pyramid = {}
+    chunks = []
+    for chunk in stream_png(shapes, size, pyramid_levels(size), pyramid.__setitem__):
+        chunks.append(chunk)
+        if emit is not None:
+            emit(chunk)
+    pyramid[0] = b''.join(chunks)
+    return pyramid
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _submit(fn):
+    # Used when the server has no render pool of its own; bounded like
+    # one, so a burst of large renders is refused with Overloaded
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = RenderPool()
+    return _pool.submit(fn)
+
+
+def tiled_png(cache, key, shapes, size, level=0, timeout=None, submit=None):
+    """Return the PNG for an image key at ``size`` and pyramid ``level``.
+
+    Cached images come back as bytes. Otherwise the full-size image and
+    every pyramid level are rendered once, by ``submit(fn)``, which returns
+    a Future and may refuse work by raising. That render is shared by
+    every request for the image at ``size``, whatever its level, and all
+    levels are cached. ``submit`` raises Overloaded when the default pool
+    is full. The request that started it gets level 0 as an
+    iterator of chunks to stream while it is encoded; all other requests
+    get bytes once it is done, or TimeoutError after ``timeout`` seconds.
+    """
+    data = cache.get(tiled_key(key, size, level))
+    if data is not None:
+        return data
+
+    flight, leader = cache.flights.claim(tiled_key(key, size))
+    if not leader:
+        pyramid = flight.wait(timeout)
+        if level in pyramid:
+            return pyramid[level]
+        # The leader found its own level cached and rendered nothing
+        return tiled_png(cache, key, shapes, size, level, timeout, submit)
+
+    # A render that finished between the lookup and the claim has cached
+    # every level already
+    data = cache.get(tiled_key(key, size, level))
+    if data is not None:
+        flight.resolve({level: data})
+        return data
+
+    chunks = queue.Queue()
+
+    def render():
+        # Runs to the end even if the client goes away, so the waiters
+        # and the cache still get the image
+        try:
+            pyramid = render_pyramid(shapes, size, chunks.put if level == 0 else None)
+            for index, png in pyramid.items():
+                cache.put(tiled_key(key, size, index), png)
+        except BaseException as exc:
+            flight.resolve(error=exc)
+            chunks.put(exc)
+            raise
+        flight.resolve(pyramid)
+        chunks.put(None)
+        return pyramid
+
+    try:
+        future = (submit or _submit)(render)
+    except BaseException as exc:
+        flight.resolve(error=exc)
+        raise
+
+    if level:
+        return future.result()[level]
+
+    def stream():
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, BaseException):
+                raise chunk
+            yield chunk
+
+    return stream()